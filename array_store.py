@@ -0,0 +1,50 @@
+import os
+import json
+import numpy as np
+
+DATA_NAME = "arrays.bin"
+INDEX_NAME = "arrays.json"
+# array offsets in the data file are rounded up to this many bytes
+ALIGNMENT = 64
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_arrays(folder,arrays):
+    # all arrays go into one raw data file, the json index records the dtype,
+    # shape and byte offset of each. both are written to temp files first so
+    # a crash never leaves a half written container
+    os.makedirs(folder,exist_ok=True)
+    data_path = os.path.join(folder,DATA_NAME)
+    index_path = os.path.join(folder,INDEX_NAME)
+    index = {}
+    with open(data_path+".tmp",'wb') as file:
+        for name,value in arrays.items():
+            value = np.asarray(value,order="C")
+            offset = align(file.tell())
+            file.seek(offset)
+            file.write(value.tobytes())
+            index[name] = {
+                "dtype":value.dtype.str,
+                "shape":list(value.shape),
+                "offset":offset,
+            }
+    with open(index_path+".tmp",'w') as file:
+        json.dump(index,file)
+    os.replace(data_path+".tmp",data_path)
+    os.replace(index_path+".tmp",index_path)
+
+def load_arrays(folder):
+    # name to array dict, every array memory mapped from the data file
+    with open(os.path.join(folder,INDEX_NAME)) as file:
+        index = json.load(file)
+    data_path = os.path.join(folder,DATA_NAME)
+    return {name:load_entry(data_path,entry) for name,entry in index.items()}
+
+def load_entry(data_path,entry):
+    dtype = np.dtype(entry["dtype"])
+    shape = tuple(entry["shape"])
+    if int(np.prod(shape)) == 0:
+        # mmap cannot map zero bytes
+        return np.zeros(shape,dtype=dtype)
+    return np.memmap(data_path,dtype=dtype,mode='r',offset=entry["offset"],shape=shape)
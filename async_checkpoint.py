@@ -0,0 +1,50 @@
+import os
+import tensorflow as tf
+from async_worker import AsyncWorker
+
+# checkpoints the training graph without stalling the training loop.
+# save() copies every variable out in one sess.run, then a background thread
+# loads the copy into a private graph and writes it with an ordinary
+# tf.train.Saver, so the files, the model.ckpt-N naming, the checkpoint state
+# file and max_to_keep retention are the same as saving inline, and
+# tf.train.Saver.restore reads them as before.
+# at most max_pending snapshots wait in memory, save() blocks past that.
+class AsyncCheckpointer:
+    def __init__(self,save_path,var_list=None,max_to_keep=50,max_pending=2):
+        self.save_path = save_path
+        self.var_list = tf.global_variables() if var_list is None else var_list
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = []
+            copies = {}
+            for var in self.var_list:
+                # checkpoint keys are the op names of the original variables
+                copy = tf.Variable(tf.zeros(var.get_shape(),dtype=var.dtype.base_dtype),name=var.op.name)
+                self.placeholders.append(tf.placeholder(var.dtype.base_dtype,var.get_shape()))
+                copies[var.op.name] = copy
+            self.load_op = tf.group([tf.assign(copies[var.op.name],place)
+                                        for var,place in zip(self.var_list,self.placeholders)])
+            self.saver = tf.train.Saver(var_list=copies,max_to_keep=max_to_keep)
+        self.sess = tf.Session(graph=self.graph,config=tf.ConfigProto(device_count={'GPU':0}))
+        self.worker = AsyncWorker(max_pending=max_pending)
+
+    def save(self,sess,global_step):
+        values = sess.run(self.var_list)
+        self.worker.submit(self.write,values,global_step)
+
+    def write(self,values,global_step):
+        self.sess.run(self.load_op,feed_dict=dict(zip(self.placeholders,values)))
+        prefix = self.saver.save(self.sess,self.save_path,global_step=global_step)
+        folder = os.path.dirname(prefix) or "."
+        for filename in os.listdir(folder):
+            if filename.startswith(os.path.basename(prefix)+".") or filename == "checkpoint":
+                with open(os.path.join(folder,filename),'rb') as file:
+                    os.fsync(file.fileno())
+        print("checkpoint {} written".format(prefix),flush=True)
+
+    def wait(self):
+        self.worker.wait()
+
+    def close(self):
+        self.worker.close()
+        self.sess.close()
@@ -0,0 +1,48 @@
+import threading
+import queue
+import traceback
+
+# runs submitted calls on background threads, in order when num_threads is 1.
+# submit() blocks once max_pending calls are waiting, which bounds the
+# memory held by queued work.
+# a failed call is printed and re-raised on the next submit, wait or close.
+class AsyncWorker:
+    def __init__(self,num_threads=1,max_pending=8):
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.threads = [threading.Thread(target=self.run,daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                fn,args = task
+                fn(*args)
+            except Exception as err:
+                traceback.print_exc()
+                self.errors.append(err)
+            finally:
+                self.tasks.task_done()
+
+    def check(self):
+        if self.errors:
+            raise RuntimeError("background task failed") from self.errors[0]
+
+    def submit(self,fn,*args):
+        self.check()
+        self.tasks.put((fn,args))
+
+    def wait(self):
+        self.tasks.join()
+        self.check()
+
+    def close(self):
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.check()
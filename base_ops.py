@@ -1,7 +1,30 @@
 import tensorflow as tf
 
+# default layout of the conv layers, 'NHWC' or 'NCHW'. every layer also
+# takes a data_format argument, models convert their input once with to_format
+# and their output once with from_format.
+# stock tensorflow 1 only has NCHW conv2d and conv2d_transpose kernels on the
+# gpu, on the cpu NCHW fails when the graph first runs, see check_format
 FORMAT = 'NHWC'
 
+def check_format(data_format):
+    if data_format not in ('NHWC','NCHW'):
+        raise ValueError("unknown data format: "+data_format)
+    if data_format == 'NCHW' and not tf.test.is_gpu_available():
+        raise ValueError("NCHW convolutions need a gpu, tensorflow has no cpu kernels for them")
+
+def channel_axis(data_format):
+    return 1 if data_format == 'NCHW' else 3
+
+def height_axis(data_format):
+    return 2 if data_format == 'NCHW' else 1
+
+def to_format(nhwc_val,data_format):
+    return tf.transpose(nhwc_val,[0,3,1,2]) if data_format == 'NCHW' else nhwc_val
+
+def from_format(val,data_format):
+    return tf.transpose(val,[0,2,3,1]) if data_format == 'NCHW' else val
+
 class Dense:
     def __init__(self,input_dim,out_dim,activation):
         out_shape = [input_dim,out_dim]
@@ -22,26 +45,29 @@ def magnitude(vec):
     assert len(vec.get_shape().as_list()) == 1
     return tf.tensordot(vec,vec,axes=1)
 
-def conv_in_out(inp,weights):
-    out = tf.nn.conv2d(input=inp,filter=weights,padding="VALID")
-    take_dim = out.get_shape().as_list()[1]//2
-    magn = magnitude(out[0][take_dim][take_dim])
-    out = out / magn
-    return out,magn
-
-def conv_out_in(out,weights):
-    filt_shape = weights.get_shape().as_list()
-    filt_size = filt_shape[0]
-    in_size = filt_shape[2]
-    take_dim = out.get_shape().as_list()[1]//2
-    out_shape = [1,out.shape[1]+filt_size-1,out.shape[2]+filt_size-1,in_size]
-    inp = tf.nn.conv2d_transpose(value=out,filter=weights,output_shape=out_shape,padding="VALID")
-    magn = magnitude(out[0][take_dim][take_dim])
-    inp = inp / magn
-    return inp,magn
+# the layer updates() are cheap enough to run every step, but only need to
+# run this often to keep the spectral norm estimates converged
+SPECNORM_INTERVAL = 4
+
+def normalize(vec):
+    return vec / (tf.sqrt(magnitude(vec))+1e-12)
+
+def spectral_norm_step(weights,u,in_axis):
+    # one power iteration on the filter flattened to [input_dim,everything else],
+    # with u the persisted left singular vector estimate of length input_dim.
+    # v is recomputed from u, so it needs no variable of its own.
+    # returns the new u and the spectral norm estimate
+    rank = len(weights.get_shape().as_list())
+    perm = [in_axis]+[axis for axis in range(rank) if axis != in_axis]
+    mat = tf.reshape(tf.transpose(weights,perm),[u.get_shape().as_list()[0],-1])
+    v = normalize(tf.linalg.matvec(mat,u,transpose_a=True))
+    mat_v = tf.linalg.matvec(mat,v)
+    new_u = normalize(mat_v)
+    sigma = tf.tensordot(new_u,mat_v,axes=1)
+    return tf.stop_gradient(new_u),tf.stop_gradient(sigma)
 
 class Conv2d:
-    def __init__(self,input_dim,out_dim,conv_size,activation,strides=[1,1],padding="SAME"):
+    def __init__(self,input_dim,out_dim,conv_size,activation,strides=[1,1],padding="SAME",data_format=FORMAT):
         assert len(conv_size) == 2,"incorrect conv size"
         out_shape = conv_size+[input_dim]+[out_dim]
         init_vals = tf.initializers.glorot_normal()(out_shape)
@@ -49,32 +75,22 @@ class Conv2d:
         self.biases = tf.Variable(tf.ones([out_dim])*0.01,name="biases",use_resource=True)
         self.specnorm_u = tf.Variable(tf.ones([input_dim])/input_dim,name="specnorm_u",use_resource=True)
         self.decay = tf.Variable(tf.ones([]),name="decay",use_resource=True)
-        self.bn = tf.layers.BatchNormalization()
+        self.bn = tf.layers.BatchNormalization(axis=channel_axis(data_format))
         self.activation = activation
         self.strides = strides
         self.padding = padding
         self.input_dim = input_dim
         self.out_dim = out_dim
+        self.data_format = data_format
 
     def updates(self):
-        cur_u = tf.reshape(self.specnorm_u,[1,1,1,self.input_dim])
-        INP_SIZE = 7
-        cur_u = tf.tile(cur_u,[1,INP_SIZE,INP_SIZE,1])
-        #print("shape")
-        #print(cur_u.shape)
-        cur_v,_ = conv_in_out(cur_u,self.weights)
-        #print(cur_v.shape)
-        cur_u,_ = conv_out_in(cur_v,self.weights)
-        #print(cur_u.shape)
-        cur_v,_ = conv_in_out(cur_u,self.weights)
-        #print(cur_v.shape)
-        cur_u,mag = conv_out_in(cur_v,self.weights)
-        #print(cur_u.shape)
+        # filter is [h,w,input_dim,out_dim]
+        cur_u,mag = spectral_norm_step(self.weights,self.specnorm_u,2)
 
         DECAY = self.decay
         new_weights = self.weights*DECAY + (1-DECAY)*self.weights/tf.maximum(1.0,mag)
         update_weights = tf.assign(self.weights,new_weights)
-        update_u_vec = tf.assign(self.specnorm_u,cur_u[0][0][0])
+        update_u_vec = tf.assign(self.specnorm_u,cur_u)
         STEPS_TO_DECAY_HALF = 100
         decay_decay = 0.5**(1.0/STEPS_TO_DECAY_HALF)
         decay_update = tf.assign(self.decay,self.decay*decay_decay)
@@ -86,10 +102,12 @@ class Conv2d:
             input=input_vec,
             filter=self.weights,
             strides=self.strides,
-            data_format=FORMAT,
+            data_format=self.data_format,
             padding=self.padding)
+        # inference mode batch norm, each image is normalised on its own, so
+        # callers may stack independent batches into one pass
         linval = self.bn(linval)
-        linval = linval + self.biases
+        linval = tf.nn.bias_add(linval,self.biases,data_format=self.data_format)
         activated = (linval if self.activation is None else
                     self.activation(linval))
         return activated
@@ -102,15 +120,15 @@ class Conv2d:
         ]
 
 
-def Conv1x1(input_dim,out_dim,activation):
-    return Conv2d(input_dim,out_dim,[1,1],activation)
+def Conv1x1(input_dim,out_dim,activation,data_format=FORMAT):
+    return Conv2d(input_dim,out_dim,[1,1],activation,data_format=data_format)
 
-def Conv1x1Upsample(input_dim,out_dim,activation,out_shape,upsample_factor):
-    return ConvTrans2d(input_dim,out_dim,[1,1],activation,out_shape,strides=[upsample_factor,upsample_factor])
+def Conv1x1Upsample(input_dim,out_dim,activation,out_shape,upsample_factor,data_format=FORMAT):
+    return ConvTrans2d(input_dim,out_dim,[1,1],activation,out_shape,strides=[upsample_factor,upsample_factor],data_format=data_format)
 
 
 class ConvTrans2d:
-    def __init__(self,input_dim,out_dim,conv_size,activation,out_shape,strides=[1,1],padding="SAME"):
+    def __init__(self,input_dim,out_dim,conv_size,activation,out_shape,strides=[1,1],padding="SAME",data_format=FORMAT):
         assert len(conv_size) == 2,"incorrect conv size"
         filter_shape = conv_size+[out_dim]+[input_dim]
         init_vals = tf.initializers.glorot_normal()(filter_shape)
@@ -123,43 +141,29 @@ class ConvTrans2d:
         self.out_dim = out_dim
         self.out_shape = out_shape
         self.input_dim = input_dim
+        self.data_format = data_format
 
     def updates(self):
-        return []
-        ITERS = 3
-        cur_u = tf.reshape(self.specnorm_u,[1,1,1,self.input_dim])
-        INP_SIZE = 7
-        cur_v = tf.tile(cur_u,[1,INP_SIZE,INP_SIZE,1])
-        print("shape")
-        cur_u,_ = conv_out_in(cur_v,self.weights)
-        print(cur_u.shape)
-        cur_v,_ = conv_in_out(cur_u,self.weights)
-        print(cur_v.shape)
-        cur_u,_ = conv_out_in(cur_v,self.weights)
-        print(cur_u.shape)
-        cur_v,mag = conv_in_out(cur_u,self.weights)
-        print(cur_v.shape)
-
-        #DECAY = 0.5
+        # filter is [h,w,out_dim,input_dim]
+        cur_u,mag = spectral_norm_step(self.weights,self.specnorm_u,3)
+
         new_weights = self.weights/tf.maximum(1.0,mag+0.001)
         update_weights = tf.assign(self.weights,new_weights)
-        update_u_vec = tf.assign(self.specnorm_u,cur_v[0][0][0])
+        update_u_vec = tf.assign(self.specnorm_u,cur_u)
         return [update_weights,update_u_vec]
 
     def calc(self,input_vec):
         in_shape = input_vec.get_shape().as_list()
-        out_shape = [
-            in_shape[0],
-            self.out_shape[0],
-            self.out_shape[1],
-            self.out_dim,
-        ]
+        if self.data_format == 'NCHW':
+            out_shape = [in_shape[0],self.out_dim,self.out_shape[0],self.out_shape[1]]
+        else:
+            out_shape = [in_shape[0],self.out_shape[0],self.out_shape[1],self.out_dim]
         linval = tf.nn.conv2d_transpose(
             value=input_vec,
             filter=self.weights,
             output_shape=out_shape,
             strides=self.strides,
-            data_format=FORMAT)
+            data_format=self.data_format)
         #affine_val = linval + self.biases
         activated = (linval if self.activation is None else
                     self.activation(linval))
@@ -169,12 +173,13 @@ class ConvTrans2d:
         return [(name,self.weights)]
 
 
-def avgpool2d(input,window_shape):
+def avgpool2d(input,window_shape,data_format=FORMAT):
     return tf.nn.pool(input,
         window_shape=window_shape,
         pooling_type="AVG",
         padding="SAME",
         strides=window_shape,
+        data_format=data_format,
         )
 
 def default_activ(input):
@@ -182,7 +187,7 @@ def default_activ(input):
 
 
 class Convpool2:
-    def __init__(self,in_dim,out_dim,out_activ,use_batchnorm=True):
+    def __init__(self,in_dim,out_dim,out_activ,use_batchnorm=True,data_format=FORMAT):
         self.CONV_SIZE = [3,3]
         self.POOL_SHAPE = [2,2]
         self.out_activ = out_activ
@@ -190,8 +195,8 @@ class Convpool2:
         #self.bn1 = tf.layers.BatchNormalization(momentum=0.9)
         #if self.use_batchnorm:
         #    self.bn2 = tf.layers.BatchNormalization(momentum=0.9)
-        self.conv1 = Conv2d(in_dim,out_dim,self.CONV_SIZE,None)
-        self.conv2 = Conv2d(out_dim,out_dim,self.CONV_SIZE,None,strides=self.POOL_SHAPE)
+        self.conv1 = Conv2d(in_dim,out_dim,self.CONV_SIZE,None,data_format=data_format)
+        self.conv2 = Conv2d(out_dim,out_dim,self.CONV_SIZE,None,strides=self.POOL_SHAPE,data_format=data_format)
 
     def updates(self):
         return (
@@ -217,11 +222,11 @@ class Convpool2:
 
 
 class Deconv2:
-    def __init__(self,in_dim,out_dim,out_activ,out_shape):
+    def __init__(self,in_dim,out_dim,out_activ,out_shape,data_format=FORMAT):
         self.CONV_SIZE = [3,3]
         self.POOL_SHAPE = [2,2]
-        self.conv1 = ConvTrans2d(in_dim,in_dim,self.CONV_SIZE,default_activ,out_shape,strides=self.POOL_SHAPE)
-        self.conv2 = ConvTrans2d(in_dim,out_dim,self.CONV_SIZE,out_activ,out_shape)
+        self.conv1 = ConvTrans2d(in_dim,in_dim,self.CONV_SIZE,default_activ,out_shape,strides=self.POOL_SHAPE,data_format=data_format)
+        self.conv2 = ConvTrans2d(in_dim,out_dim,self.CONV_SIZE,out_activ,out_shape,data_format=data_format)
 
     def updates(self):
         return (
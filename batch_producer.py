@@ -0,0 +1,115 @@
+import threading
+import traceback
+import numpy as np
+import tensorflow as tf
+from img_shards import gather_rows
+
+# whole batches waiting in the queue ahead of the training step
+PREFETCH_BATCHES = 8
+
+# feeds whole batches into a tf.FIFOQueue from a background thread.
+# the graph is built on dequeue(), so the training step never goes
+# through feed_dict and batch assembly overlaps with the step.
+# dequeued tensors can still be fed directly, e.g. for preview passes.
+class BatchProducer:
+    def __init__(self,shapes,dtypes,capacity=PREFETCH_BATCHES):
+        self.placeholders = [tf.placeholder(shape=shape,dtype=dtype) for shape,dtype in zip(shapes,dtypes)]
+        self.queue = tf.FIFOQueue(capacity,dtypes,shapes=shapes)
+        self.enqueue_op = self.queue.enqueue(self.placeholders)
+        self.close_op = self.queue.close(cancel_pending_enqueues=True)
+        self.thread = None
+
+    def dequeue(self):
+        outs = self.queue.dequeue()
+        if not isinstance(outs,(list,tuple)):
+            outs = [outs]
+        return outs
+
+    def start(self,sess,batch_iter):
+        # batch_iter yields a tuple of arrays per batch, matching shapes and dtypes
+        def run():
+            try:
+                for batch in batch_iter:
+                    sess.run(self.enqueue_op,feed_dict=dict(zip(self.placeholders,batch)))
+            except tf.errors.CancelledError:
+                return
+            except Exception:
+                traceback.print_exc()
+            # wakes up the training thread with an OutOfRangeError
+            sess.run(self.close_op)
+
+        self.thread = threading.Thread(target=run,daemon=True)
+        self.thread.start()
+
+    def stop(self,sess):
+        sess.run(self.close_op)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def shuffled_batches(arrays,batch_size,num_buffers=PREFETCH_BATCHES+3):
+    # arrays is a tuple of arrays (or ShardReaders) sharing their first dimension.
+    # each epoch is one permutation of indices and each batch is a single
+    # fancy indexed gather per array into a preallocated buffer.
+    # tf may alias fed arrays in queued tensors, so the buffers are rotated
+    # and never refilled while the queue could still hold them.
+    num_items = len(arrays[0])
+    buffers = [tuple(np.empty((batch_size,)+tuple(arr.shape[1:]),dtype=arr.dtype) for arr in arrays)
+                    for _ in range(num_buffers)]
+    buffer_idx = 0
+    while True:
+        perm = np.random.permutation(num_items)
+        for start in range(0,num_items-batch_size+1,batch_size):
+            idxs = perm[start:start+batch_size]
+            batch = buffers[buffer_idx]
+            buffer_idx = (buffer_idx+1) % num_buffers
+            for arr,out in zip(arrays,batch):
+                gather_rows(arr,idxs,out)
+            yield batch
+
+# examples held in the tf.data shuffle buffer
+SHUFFLE_BUFFER = 8192
+
+# tf.data alternative to BatchProducer with the same dequeue() interface.
+# the source arrays are fed once into an initializable iterator, then
+# shuffling, the per example map (casting, augmentation), batching and
+# prefetching all run on tf's own thread pool instead of in python.
+class DatasetProducer:
+    def __init__(self,shapes,dtypes,map_fn=None,shuffle_buffer=SHUFFLE_BUFFER,capacity=PREFETCH_BATCHES):
+        # shapes are batch shapes, the leading dimension is the batch size
+        batch_size = shapes[0][0]
+        self.sources = [tf.placeholder(shape=[None]+list(shape[1:]),dtype=dtype) for shape,dtype in zip(shapes,dtypes)]
+        dataset = tf.data.Dataset.from_tensor_slices(tuple(self.sources))
+        dataset = dataset.shuffle(shuffle_buffer).repeat()
+        if map_fn is not None:
+            dataset = dataset.map(map_fn,num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.batch(batch_size,drop_remainder=True)
+        dataset = dataset.prefetch(capacity)
+        self.iterator = dataset.make_initializable_iterator()
+
+    def dequeue(self):
+        outs = self.iterator.get_next()
+        if not isinstance(outs,(list,tuple)):
+            outs = [outs]
+        return list(outs)
+
+    def start(self,sess,arrays):
+        # arrays holds one array per component covering the whole dataset,
+        # memory mapped sources are read into memory here
+        sess.run(self.iterator.initializer,feed_dict={source:np.asarray(arr) for source,arr in zip(self.sources,arrays)})
+
+    def stop(self,sess):
+        pass
+
+def uint8_to_float(img,*rest):
+    return (tf.cast(img,tf.float32)/256.0,)+rest
+
+def random_flip(img,*rest):
+    return (tf.image.random_flip_left_right(img),)+rest
+
+def compose(*fns):
+    def composed(*vals):
+        for fn in fns:
+            vals = fn(*vals)
+        return vals
+    return composed
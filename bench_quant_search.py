@@ -0,0 +1,70 @@
+import time
+import numpy as np
+import tensorflow as tf
+from quant_block import nearest_codes,CodebookSearchIndex,LowPrecisionSearch,LOW_PRECISION_MODES
+from check_low_precision import MIN_LOW_PRECISION_MATCH
+
+# recall and speed of the approximate and low precision codeword searches
+# against the exact float32 one. check_low_precision.py is the pass/fail
+# check of the low precision match.
+# inputs are codewords plus noise, so they cluster the way encoder outputs do
+NUM_QUANT = 4
+QUANT_DIM = 48
+NUM_ROWS = 64*12*12
+QUANT_SIZES = [256,1024,4096]
+PROBES = [1,2,4,8]
+NOISE = 0.5
+RUNS = 10
+
+def time_run(sess,op,feed_dict):
+    sess.run(op,feed_dict=feed_dict)
+    times = []
+    for _ in range(RUNS):
+        start = time.time()
+        out = sess.run(op,feed_dict=feed_dict)
+        times.append(time.time()-start)
+    return out,np.median(times)
+
+def bench_size(QUANT_SIZE):
+    tf.reset_default_graph()
+    rng = np.random.RandomState(0)
+    codebook = rng.normal(size=[NUM_QUANT,QUANT_SIZE,QUANT_DIM]).astype(np.float32)
+    picked = codebook[np.arange(NUM_QUANT),rng.randint(QUANT_SIZE,size=[NUM_ROWS,NUM_QUANT])]
+    inputs = (picked + NOISE*rng.normal(size=picked.shape)).astype(np.float32)
+
+    vecs = tf.constant(codebook)
+    input_place = tf.placeholder(tf.float32,[NUM_ROWS,NUM_QUANT,QUANT_DIM])
+    dist_scale = tf.ones([NUM_QUANT,QUANT_SIZE])
+    exact_op = nearest_codes(input_place,vecs,dist_scale)
+    approx_ops = []
+    for num_probes in PROBES:
+        index = CodebookSearchIndex(QUANT_SIZE,NUM_QUANT,QUANT_DIM,num_probes=num_probes)
+        approx_ops.append((index,nearest_codes(input_place,vecs,dist_scale,search_index=index)))
+    low_ops = []
+    for mode,dtype in LOW_PRECISION_MODES.items():
+        low_ops.append((mode,nearest_codes(input_place,vecs,dist_scale,search_index=LowPrecisionSearch(dtype))))
+
+    with tf.Session() as sess:
+        sess.run(tf.local_variables_initializer())
+        feed_dict = {input_place:inputs}
+        exact_idxs,exact_time = time_run(sess,exact_op,feed_dict)
+        print("QUANT_SIZE {:5d}  exact                      {:8.2f} ms".format(QUANT_SIZE,exact_time*1000))
+        for index,approx_op in approx_ops:
+            index.rebuild(sess,vecs)
+            approx_idxs,approx_time = time_run(sess,approx_op,feed_dict)
+            recall = np.mean(approx_idxs == exact_idxs)
+            print("QUANT_SIZE {:5d}  probes {}/{:3d}  recall {:.4f} {:8.2f} ms  speedup {:.2f}x".format(
+                QUANT_SIZE,index.num_probes,index.num_coarse,recall,approx_time*1000,exact_time/approx_time),flush=True)
+        for mode,low_op in low_ops:
+            low_idxs,low_time = time_run(sess,low_op,feed_dict)
+            match = np.mean(low_idxs == exact_idxs)
+            print("QUANT_SIZE {:5d}  {:16s} match {:.4f} {:8.2f} ms  speedup {:.2f}x  {}".format(
+                QUANT_SIZE,mode,match,low_time*1000,exact_time/low_time,
+                "ok" if match >= MIN_LOW_PRECISION_MATCH else "BELOW {}".format(MIN_LOW_PRECISION_MATCH)),flush=True)
+
+def main():
+    for QUANT_SIZE in QUANT_SIZES:
+        bench_size(QUANT_SIZE)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import time
+import numpy as np
+import tensorflow as tf
+from quant_block import QuantBlockImg
+from ema import VectorQuantizerEMA
+
+# step time, peak memory and code perplexity of QuantBlockImg against
+# ema.VectorQuantizerEMA, at the three quant levels of train_passthrough.MainCalc.
+# each level is (QUANT_SIZE,NUM_QUANT,QUANT_DIM,feature map height and width)
+BATCH_SIZE = 64
+LEVELS = [
+    (128,2,48,24),
+    (256,4,48,6),
+    (256,4,64,2),
+]
+WARMUP = 5
+RUNS = 50
+
+def make_quantizer(kind,QUANT_SIZE,NUM_QUANT,QUANT_DIM):
+    if kind == "QuantBlockImg":
+        return QuantBlockImg(QUANT_SIZE,NUM_QUANT,QUANT_DIM)
+    else:
+        return VectorQuantizerEMA(QUANT_DIM,QUANT_SIZE,NUM_QUANT)
+
+def peak_bytes(run_metadata):
+    # largest allocator peak seen by any node of a traced step
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for mem in node_stats.memory:
+                peak = max(peak,mem.peak_bytes)
+    return peak
+
+def perplexity(codes,QUANT_SIZE):
+    # perplexity of the code usage over the last batch, averaged over codebooks
+    flat = codes.reshape([-1,codes.shape[-1]])
+    perps = []
+    for quant in range(flat.shape[1]):
+        probs = np.bincount(flat[:,quant],minlength=QUANT_SIZE) / len(flat)
+        perps.append(np.exp(-np.sum(probs*np.log(probs+1e-10))))
+    return np.mean(perps)
+
+def bench_level(kind,QUANT_SIZE,NUM_QUANT,QUANT_DIM,size):
+    tf.reset_default_graph()
+    rng = np.random.RandomState(0)
+    in_shape = [BATCH_SIZE,size,size,NUM_QUANT*QUANT_DIM]
+    input_place = tf.placeholder(tf.float32,in_shape)
+    quantizer = make_quantizer(kind,QUANT_SIZE,NUM_QUANT,QUANT_DIM)
+    out,loss,update,codes = quantizer.calc(input_place)
+    grad = tf.gradients(loss+tf.reduce_sum(out),input_place)[0]
+    step = [grad,update,codes]
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        feed_dict = {input_place:rng.normal(size=in_shape).astype(np.float32)}
+        for _ in range(WARMUP):
+            sess.run(step,feed_dict=feed_dict)
+        times = []
+        for _ in range(RUNS):
+            start = time.time()
+            _,_,code_vals = sess.run(step,feed_dict=feed_dict)
+            times.append(time.time()-start)
+        run_metadata = tf.RunMetadata()
+        sess.run(step,feed_dict=feed_dict,
+            options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),run_metadata=run_metadata)
+    print("{:20s} {:4d}x{}x{:<3d} {:2d}x{:<2d}  {:8.2f} ms  peak {:8.1f} MB  perplexity {:7.1f}".format(
+        kind,QUANT_SIZE,NUM_QUANT,QUANT_DIM,size,size,np.median(times)*1000,
+        peak_bytes(run_metadata)/2**20,perplexity(code_vals,QUANT_SIZE)),flush=True)
+
+def main():
+    for level in LEVELS:
+        for kind in ["QuantBlockImg","VectorQuantizerEMA"]:
+            bench_level(kind,*level)
+
+if __name__ == "__main__":
+    main()
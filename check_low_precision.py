@@ -0,0 +1,56 @@
+import sys
+import numpy as np
+import tensorflow as tf
+from quant_block import nearest_codes,LowPrecisionSearch,LOW_PRECISION_MODES
+
+# checks that the low precision codeword search picks the float32 code.
+# exits non-zero if any mode matches on less than MIN_LOW_PRECISION_MATCH
+# of the rows. inputs are codewords plus noise, like bench_quant_search,
+# but noisy enough that near ties are common: without the float32 recheck
+# the search matches on only 97-99.7% of rows here
+NUM_QUANT = 4
+QUANT_DIM = 48
+NUM_ROWS = 64*12*12
+QUANT_SIZES = [256,1024,4096]
+NOISE = 2.0
+# the float32 recheck leaves only rows whose true nearest code rounding pushed
+# out of the top few candidates, which at these sizes is well under 0.1%
+MIN_LOW_PRECISION_MATCH = 0.999
+
+def make_inputs(QUANT_SIZE,rng):
+    codebook = rng.normal(size=[NUM_QUANT,QUANT_SIZE,QUANT_DIM]).astype(np.float32)
+    picked = codebook[np.arange(NUM_QUANT),rng.randint(QUANT_SIZE,size=[NUM_ROWS,NUM_QUANT])]
+    inputs = (picked + NOISE*rng.normal(size=picked.shape)).astype(np.float32)
+    return codebook,inputs
+
+def check_size(QUANT_SIZE):
+    # returns the modes that fell below the tolerance
+    tf.reset_default_graph()
+    codebook,inputs = make_inputs(QUANT_SIZE,np.random.RandomState(0))
+    vecs = tf.constant(codebook)
+    input_place = tf.placeholder(tf.float32,[NUM_ROWS,NUM_QUANT,QUANT_DIM])
+    dist_scale = tf.ones([NUM_QUANT,QUANT_SIZE])
+    exact_op = nearest_codes(input_place,vecs,dist_scale)
+    low_ops = {mode:nearest_codes(input_place,vecs,dist_scale,search_index=LowPrecisionSearch(dtype))
+                for mode,dtype in LOW_PRECISION_MODES.items()}
+    failed = []
+    with tf.Session() as sess:
+        exact_idxs,low_idxs = sess.run([exact_op,low_ops],feed_dict={input_place:inputs})
+    for mode,idxs in low_idxs.items():
+        match = np.mean(idxs == exact_idxs)
+        ok = match >= MIN_LOW_PRECISION_MATCH
+        print("QUANT_SIZE {:5d}  {:8s} match {:.5f}  {}".format(QUANT_SIZE,mode,match,"ok" if ok else "FAILED"),flush=True)
+        if not ok:
+            failed.append((QUANT_SIZE,mode))
+    return failed
+
+def main():
+    failed = []
+    for QUANT_SIZE in QUANT_SIZES:
+        failed += check_size(QUANT_SIZE)
+    if failed:
+        print("low precision search below {} match for {}".format(MIN_LOW_PRECISION_MATCH,failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
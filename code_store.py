@@ -0,0 +1,42 @@
+import os
+import json
+import numpy as np
+
+CODES_FOLDER = "data/pretrained_codes/"
+NAMES_FILE = "names.json"
+CODE_DTYPE = np.uint16
+
+def code_path(folder,level):
+    return os.path.join(folder,"closest{}.npy".format(level))
+
+def load_names(folder=CODES_FOLDER):
+    with open(os.path.join(folder,NAMES_FILE)) as file:
+        return json.load(file)
+
+def load_codes(folder=CODES_FOLDER,level=1):
+    # [num_images,H,W,NUM_QUANT] codes for one quant level, memory mapped
+    return np.load(code_path(folder,level),mmap_mode='r')
+
+def has_codes(folder=CODES_FOLDER):
+    return os.path.exists(os.path.join(folder,NAMES_FILE))
+
+# one .npy array per quant level, row i holds the codes of image names[i].
+# rows are written in place through memory maps, so the arrays can be
+# filled batch by batch without ever holding a whole level in memory.
+class CodeWriter:
+    def __init__(self,folder,names,level_shapes):
+        os.makedirs(folder,exist_ok=True)
+        self.folder = folder
+        self.levels = [np.lib.format.open_memmap(code_path(folder,level+1),mode='w+',dtype=CODE_DTYPE,shape=(len(names),)+tuple(shape))
+                            for level,shape in enumerate(level_shapes)]
+        with open(os.path.join(folder,NAMES_FILE),'w') as file:
+            json.dump(list(names),file)
+
+    def write(self,start_idx,level_codes):
+        for level,codes in zip(self.levels,level_codes):
+            level[start_idx:start_idx+len(codes)] = codes
+
+    def close(self):
+        for level in self.levels:
+            level.flush()
+        self.levels = []
@@ -0,0 +1,57 @@
+import numpy as np
+
+# candidate slots per coarse cluster, relative to an even split of the codes
+CAPACITY_SLACK = 2.0
+KMEANS_ITERS = 10
+
+def default_num_coarse(QUANT_SIZE):
+    return max(1,int(round(np.sqrt(QUANT_SIZE))))
+
+def cluster_capacity(QUANT_SIZE,num_coarse,slack=CAPACITY_SLACK):
+    return int(np.ceil(slack*QUANT_SIZE/num_coarse))
+
+def sqr_dists(points,centroids):
+    return (np.sum(points*points,axis=-1,keepdims=True)
+            - 2 * points @ centroids.T
+            + np.sum(centroids*centroids,axis=-1))
+
+def kmeans(points,num_clusters,iters=KMEANS_ITERS,rng=np.random):
+    centroids = points[rng.choice(len(points),num_clusters,replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmin(sqr_dists(points,centroids),axis=1)
+        counts = np.bincount(assign,minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums,assign,points)
+        # empty clusters keep their old centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled,None]
+    return centroids
+
+def capacity_assign(dists,capacity):
+    # dists is [QUANT_SIZE,num_coarse]. every code joins its nearest cluster
+    # that still has room, codes that sit closest to a centroid are placed first.
+    # returns [num_coarse,capacity] member code indexes padded with -1
+    num_codes,num_coarse = dists.shape
+    members = np.full((num_coarse,capacity),-1,dtype=np.int64)
+    fill = np.zeros(num_coarse,dtype=np.int64)
+    prefs = np.argsort(dists,axis=1)
+    for code in np.argsort(dists.min(axis=1)):
+        for cluster in prefs[code]:
+            if fill[cluster] < capacity:
+                members[cluster,fill[cluster]] = code
+                fill[cluster] += 1
+                break
+    return members
+
+def build_coarse_index(vectors,num_coarse,capacity,iters=KMEANS_ITERS,rng=np.random):
+    # vectors is a [NUM_QUANT,QUANT_SIZE,QUANT_DIM] codebook. returns coarse
+    # centroids [NUM_QUANT,num_coarse,QUANT_DIM] and the codes belonging to
+    # each centroid [NUM_QUANT,num_coarse,capacity], padded with -1
+    assert num_coarse*capacity >= vectors.shape[1],"coarse index cannot hold every code"
+    all_centroids = []
+    all_members = []
+    for codebook in vectors:
+        centroids = kmeans(codebook,num_coarse,iters,rng)
+        all_centroids.append(centroids)
+        all_members.append(capacity_assign(sqr_dists(codebook,centroids),capacity))
+    return np.stack(all_centroids).astype(vectors.dtype),np.stack(all_members)
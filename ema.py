@@ -1,7 +1,10 @@
+import tensorflow as tf
+from tensorflow.python.training import moving_averages
+from quant_block import low_precision_search, check_low_precision_dtype
 
 
-class VectorQuantizerEMA(base.AbstractModule):
-  """Sonnet module representing the VQ-VAE layer.
+class VectorQuantizerEMA:
+  """VQ-VAE layer, adapted from the Sonnet module of the same name.
 
   Implements a slightly modified version of the algorithm presented in
   'Neural Discrete Representation Learning' by van den Oord et al.
@@ -20,49 +23,66 @@ class VectorQuantizerEMA(base.AbstractModule):
 
   The output tensor will have the same shape as the input.
 
-  For example a tensor with shape [16, 32, 32, 64] will be reshaped into
-  [16384, 64] and all 16384 vectors (each of 64 dimensions)  will be quantized
-  independently.
+  Like QuantBlock, and unlike the Sonnet module, it keeps num_codebooks
+  independent codebooks. The last two input dimensions are
+  [num_codebooks, embedding_dim] and slice i is quantized with codebook i.
+  calc() takes the same arguments and returns the same values as
+  QuantBlockImg.calc. Its loss is the mean rather than the sum of the
+  squared commitment error, so scale commitment_cost to match QuantBlock.
+
+  For example a tensor with shape [16, 32, 32, 4, 64] will be reshaped into
+  [16384, 4, 64] and all 16384*4 vectors (each of 64 dimensions) will be
+  quantized independently, each with the codebook of its slice.
 
   Args:
     embedding_dim: integer representing the dimensionality of the tensors in the
       quantized space. Inputs to the modules must be in this format as well.
-    num_embeddings: integer, the number of vectors in the quantized space.
+    num_embeddings: integer, the number of vectors in each codebook.
+    num_codebooks: integer, the number of independent codebooks.
     commitment_cost: scalar which controls the weighting of the loss terms (see
       equation 4 in the paper).
     decay: float, decay for the moving averages.
     epsilon: small float constant to avoid numerical instability.
+    distance_dtype: tf.float16 or tf.bfloat16 computes the distance matmul in
+      that precision, with a float32 recheck of the nearest few candidates.
+      None keeps the whole search in float32. Raises ValueError if this
+      TensorFlow build has no kernel for the dtype.
   """
 
-  def __init__(self, embedding_dim, num_embeddings, commitment_cost, decay,
-               epsilon=1e-5, name='VectorQuantizerEMA'):
-    super(VectorQuantizerEMA, self).__init__(name=name)
+  def __init__(self, embedding_dim, num_embeddings, num_codebooks=1,
+               commitment_cost=0.25, decay=0.99, epsilon=1e-5,
+               distance_dtype=None, name='VectorQuantizerEMA'):
     self._embedding_dim = embedding_dim
     self._num_embeddings = num_embeddings
+    self._num_codebooks = num_codebooks
     self._decay = decay
     self._commitment_cost = commitment_cost
     self._epsilon = epsilon
+    self._distance_dtype = distance_dtype
+    if distance_dtype is not None:
+      check_low_precision_dtype(distance_dtype)
 
-    with self._enter_variable_scope():
+    with tf.variable_scope(None, default_name=name):
       initializer = tf.random_normal_initializer()
-      # w is a matrix with an embedding in each column. When training, the
-      # embedding is assigned to be the average of all inputs assigned to that
-      # embedding.
+      # w holds one matrix per codebook with an embedding in each column.
+      # When training, the embedding is assigned to be the average of all
+      # inputs assigned to that embedding.
       self._w = tf.get_variable(
-          'embedding', [embedding_dim, num_embeddings],
+          'embedding', [num_codebooks, embedding_dim, num_embeddings],
           initializer=initializer, use_resource=True)
       self._ema_cluster_size = tf.get_variable(
-          'ema_cluster_size', [num_embeddings],
+          'ema_cluster_size', [num_codebooks, num_embeddings],
           initializer=tf.constant_initializer(0), use_resource=True)
       self._ema_w = tf.get_variable(
           'ema_dw', initializer=self._w.initialized_value(), use_resource=True)
 
-  def _build(self, inputs, is_training):
+  def __call__(self, inputs, is_training):
     """Connects the module to some inputs.
 
     Args:
-      inputs: Tensor, final dimension must be equal to embedding_dim. All other
-        leading dimensions will be flattened and treated as a large batch.
+      inputs: Tensor, final two dimensions must be equal to
+        [num_codebooks, embedding_dim]. All other leading dimensions will be
+        flattened and treated as a large batch.
       is_training: boolean, whether this connection is to training data. When
         this is set to False, the internal moving average statistics will not be
         updated.
@@ -71,7 +91,8 @@ class VectorQuantizerEMA(base.AbstractModule):
       dict containing the following keys and values:
         quantize: Tensor containing the quantized version of the input.
         loss: Tensor containing the loss to optimize.
-        perplexity: Tensor containing the perplexity of the encodings.
+        perplexity: Tensor containing the perplexity of the encodings of
+          each codebook.
         encodings: Tensor containing the discrete encodings, ie which element
           of the quantized space each input element was mapped to.
         encoding_indices: Tensor containing the discrete encoding indices, ie
@@ -86,33 +107,46 @@ class VectorQuantizerEMA(base.AbstractModule):
       w = self._w.read_value()
     input_shape = tf.shape(inputs)
     with tf.control_dependencies([
-        tf.Assert(tf.equal(input_shape[-1], self._embedding_dim),
+        tf.Assert(tf.logical_and(
+            tf.equal(input_shape[-1], self._embedding_dim),
+            tf.equal(input_shape[-2], self._num_codebooks)),
                   [input_shape])]):
-      flat_inputs = tf.reshape(inputs, [-1, self._embedding_dim])
+      flat_inputs = tf.reshape(
+          inputs, [-1, self._num_codebooks, self._embedding_dim])
 
-    distances = (tf.reduce_sum(flat_inputs**2, 1, keepdims=True)
-                 - 2 * tf.matmul(flat_inputs, w)
-                 + tf.reduce_sum(w ** 2, 0, keepdims=True))
+    if self._distance_dtype is None:
+      # [N, num_codebooks, num_embeddings], each slice against its own codebook
+      distances = (tf.reduce_sum(flat_inputs**2, 2, keepdims=True)
+                   - 2 * tf.einsum('ncd,cdk->nck', flat_inputs, w)
+                   + tf.reduce_sum(w ** 2, 1))
 
-    encoding_indices = tf.argmax(- distances, 1)
+      encoding_indices = tf.argmax(- distances, 2)
+    else:
+      encoding_indices = low_precision_search(
+          flat_inputs, tf.transpose(w, [0, 2, 1]),
+          tf.ones([self._num_codebooks, self._num_embeddings]),
+          self._distance_dtype)
     encodings = tf.one_hot(encoding_indices, self._num_embeddings)
     encoding_indices = tf.reshape(encoding_indices, tf.shape(inputs)[:-1])
     quantized = self.quantize(encoding_indices)
     e_latent_loss = tf.reduce_mean((tf.stop_gradient(quantized) - inputs) ** 2)
 
     if is_training:
+      # zero_debias=False keeps assign_moving_average from creating debias
+      # variables, which would collide when the module is connected twice
       updated_ema_cluster_size = moving_averages.assign_moving_average(
-          self._ema_cluster_size, tf.reduce_sum(encodings, 0), self._decay)
-      dw = tf.matmul(flat_inputs, encodings, transpose_a=True)
-      updated_ema_w = moving_averages.assign_moving_average(self._ema_w, dw,
-                                                            self._decay)
-      n = tf.reduce_sum(updated_ema_cluster_size)
+          self._ema_cluster_size, tf.reduce_sum(encodings, 0), self._decay,
+          zero_debias=False)
+      dw = tf.einsum('ncd,nck->cdk', flat_inputs, encodings)
+      updated_ema_w = moving_averages.assign_moving_average(
+          self._ema_w, dw, self._decay, zero_debias=False)
+      n = tf.reduce_sum(updated_ema_cluster_size, 1, keepdims=True)
       updated_ema_cluster_size = (
           (updated_ema_cluster_size + self._epsilon)
           / (n + self._num_embeddings * self._epsilon) * n)
 
       normalised_updated_ema_w = (
-          updated_ema_w / tf.reshape(updated_ema_cluster_size, [1, -1]))
+          updated_ema_w / updated_ema_cluster_size[:, tf.newaxis, :])
       with tf.control_dependencies([e_latent_loss]):
         update_w = tf.assign(self._w, normalised_updated_ema_w)
         with tf.control_dependencies([update_w]):
@@ -122,7 +156,8 @@ class VectorQuantizerEMA(base.AbstractModule):
       loss = self._commitment_cost * e_latent_loss
     quantized = inputs + tf.stop_gradient(quantized - inputs)
     avg_probs = tf.reduce_mean(encodings, 0)
-    perplexity = tf.exp(- tf.reduce_sum(avg_probs * tf.log(avg_probs + 1e-10)))
+    perplexity = tf.exp(
+        - tf.reduce_sum(avg_probs * tf.log(avg_probs + 1e-10), 1))
 
     return {'quantize': quantized,
             'loss': loss,
@@ -130,11 +165,33 @@ class VectorQuantizerEMA(base.AbstractModule):
             'encodings': encodings,
             'encoding_indices': encoding_indices,}
 
+  def calc(self, input):
+    """Quantizes a [B,H,W,num_codebooks*embedding_dim] feature map.
+
+    Returns:
+      quantized output, commitment loss, the op updating the codebook and the
+      [B,H,W,num_codebooks] code indexes, like QuantBlockImg.calc.
+    """
+    in_shape = input.get_shape().as_list()
+    split = tf.reshape(
+        input, in_shape[:3] + [self._num_codebooks, self._embedding_dim])
+    # the codebook is assigned inside the loss's control dependencies, so
+    # running the loss is what updates it
+    outs = self(split, is_training=True)
+    quantized = tf.reshape(outs['quantize'], in_shape)
+    update = tf.group([outs['loss']])
+    return quantized, outs['loss'], update, outs['encoding_indices']
+
   @property
   def embeddings(self):
     return self._w
 
   def quantize(self, encoding_indices):
+    # encoding_indices is [..., num_codebooks], index i picks from codebook i
     with tf.control_dependencies([encoding_indices]):
-      w = tf.transpose(self.embeddings.read_value(), [1, 0])
-    return tf.nn.embedding_lookup(w, encoding_indices, validate_indices=False)
+      w = tf.transpose(self.embeddings.read_value(), [0, 2, 1])
+    flat_w = tf.reshape(
+        w, [self._num_codebooks * self._num_embeddings, self._embedding_dim])
+    flat_indices = (tf.range(self._num_codebooks, dtype=encoding_indices.dtype)
+                    * self._num_embeddings + encoding_indices)
+    return tf.nn.embedding_lookup(flat_w, flat_indices, validate_indices=False)
@@ -0,0 +1,227 @@
+import os
+import copy
+import json
+import numpy as np
+from PIL import Image
+
+IMG_SHAPE = (96,96,3)
+SHARD_SIZE = 8192
+INDEX_NAME = "index.json"
+
+INPUT_FOLDER = "data/input_data/"
+SHARD_FOLDER = "data/input_shards/"
+
+def shard_name(shard_idx):
+    return "shard_{:05d}.bin".format(shard_idx)
+
+def write_index(folder,index):
+    # write to a temp file first so a crash never leaves a half written index
+    path = os.path.join(folder,INDEX_NAME)
+    tmp_path = path+".tmp"
+    with open(tmp_path,'w') as file:
+        json.dump(index,file)
+    os.replace(tmp_path,path)
+
+def read_index(folder):
+    with open(os.path.join(folder,INDEX_NAME)) as file:
+        return json.load(file)
+
+def has_shards(folder):
+    return os.path.exists(os.path.join(folder,INDEX_NAME))
+
+
+# packs fixed size uint8 images into raw fixed stride shard files.
+# index.json records the image shape, the number of images
+# in each shard, the filename of every image in order and the dead rows,
+# images replaced by a later add of the same filename or removed.
+# readers skip dead rows, their bytes stay in the shards.
+# with append=True an existing index is reopened and anything written
+# past it by an interrupted run is truncated away before appending.
+class ShardWriter:
+    def __init__(self,folder,img_shape=IMG_SHAPE,shard_size=SHARD_SIZE,append=False):
+        os.makedirs(folder,exist_ok=True)
+        self.folder = folder
+        self.img_shape = tuple(img_shape)
+        self.shard_size = shard_size
+        self.shard_counts = []
+        self.filenames = []
+        self.dead = set()
+        self.live_rows = {}
+        self.cur_file = None
+        if append and has_shards(folder):
+            self.reopen()
+
+    def img_bytes(self):
+        return int(np.prod(self.img_shape))
+
+    def reopen(self):
+        index = read_index(self.folder)
+        if tuple(index["img_shape"]) != self.img_shape:
+            raise ValueError("existing shards have shape {}, expected {}".format(index["img_shape"],self.img_shape))
+        self.shard_counts = index["shard_counts"]
+        self.filenames = index["filenames"]
+        self.dead = set(index.get("dead",[]))
+        self.live_rows = {name:row for row,name in enumerate(self.filenames) if row not in self.dead}
+        if self.shard_counts and self.shard_counts[-1] < self.shard_size:
+            shard_path = os.path.join(self.folder,shard_name(len(self.shard_counts)-1))
+            self.cur_file = open(shard_path,'r+b')
+            self.cur_file.truncate(self.shard_counts[-1]*self.img_bytes())
+            self.cur_file.seek(0,os.SEEK_END)
+
+    def add(self,img_arr,filename):
+        if img_arr.shape != self.img_shape or img_arr.dtype != np.uint8:
+            raise ValueError("image {} has shape {} {}, expected {} uint8".format(filename,img_arr.shape,img_arr.dtype,self.img_shape))
+        if self.cur_file is None:
+            shard_path = os.path.join(self.folder,shard_name(len(self.shard_counts)))
+            self.cur_file = open(shard_path,'wb')
+            self.shard_counts.append(0)
+        self.cur_file.write(np.ascontiguousarray(img_arr).tobytes())
+        self.shard_counts[-1] += 1
+        self.remove(filename)
+        self.live_rows[filename] = len(self.filenames)
+        self.filenames.append(filename)
+        location = "{}:{}".format(shard_name(len(self.shard_counts)-1),self.shard_counts[-1]-1)
+        if self.shard_counts[-1] == self.shard_size:
+            self.close_shard()
+        return location
+
+    def remove(self,filename):
+        # hides the current row of filename, if there is one
+        row = self.live_rows.pop(filename,None)
+        if row is not None:
+            self.dead.add(row)
+
+    def __len__(self):
+        return len(self.live_rows)
+
+    def flush(self):
+        # after flush, everything added so far is recorded in the index
+        if self.cur_file is not None:
+            self.cur_file.flush()
+            os.fsync(self.cur_file.fileno())
+        self.write_index()
+
+    def close_shard(self):
+        if self.cur_file is not None:
+            self.cur_file.close()
+            self.cur_file = None
+            self.write_index()
+
+    def write_index(self):
+        write_index(self.folder,{
+            "img_shape":list(self.img_shape),
+            "shard_counts":self.shard_counts,
+            "filenames":self.filenames,
+            "dead":sorted(self.dead),
+        })
+
+    def close(self):
+        self.close_shard()
+        self.write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+# memory maps the shards written by ShardWriter, so only the
+# pages touched by a batch are ever read from disk.
+# only live rows are visible, index i is the i-th live row and
+# filenames lists the live filenames in the same order.
+class ShardReader:
+    def __init__(self,folder):
+        index = read_index(folder)
+        self.folder = folder
+        self.img_shape = tuple(index["img_shape"])
+        dead = set(index.get("dead",[]))
+        self.rows = np.array([row for row in range(len(index["filenames"])) if row not in dead],dtype=np.int64)
+        self.filenames = [index["filenames"][row] for row in self.rows]
+        shard_counts = index["shard_counts"]
+        self.shards = [np.memmap(os.path.join(folder,shard_name(idx)),dtype=np.uint8,mode='r',shape=(count,)+self.img_shape)
+                            for idx,count in enumerate(shard_counts) if count > 0]
+        self.offsets = np.cumsum([0]+[count for count in shard_counts if count > 0])
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def shape(self):
+        return (len(self),)+self.img_shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.uint8)
+
+    def __array__(self,dtype=None):
+        # reads every shard into one in memory array
+        arr = self.get_batch(np.arange(len(self)))
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getitem__(self,idx):
+        if idx < 0 or idx >= len(self):
+            raise IndexError("shard index {} out of range".format(idx))
+        idx = self.rows[idx]
+        shard_idx = np.searchsorted(self.offsets,idx,side='right')-1
+        return self.shards[shard_idx][idx-self.offsets[shard_idx]]
+
+    def get_batch(self,idxs,out=None):
+        idxs = self.rows[np.asarray(idxs,dtype=np.int64)]
+        if out is None:
+            out = np.empty((len(idxs),)+self.img_shape,dtype=np.uint8)
+        shard_idxs = np.searchsorted(self.offsets,idxs,side='right')-1
+        for shard_idx in np.unique(shard_idxs):
+            mask = shard_idxs == shard_idx
+            out[mask] = self.shards[shard_idx][idxs[mask]-self.offsets[shard_idx]]
+        return out
+
+    def name_to_idx(self):
+        return {name:idx for idx,name in enumerate(self.filenames)}
+
+    def select(self,names):
+        # a reader over the same memory maps whose index i is the image names[i]
+        name_to_idx = self.name_to_idx()
+        missing = [name for name in names if name not in name_to_idx]
+        if missing:
+            raise ValueError("{} images are not live in the shards at {}, first missing: {}".format(len(missing),self.folder,missing[0]))
+        subset = copy.copy(self)
+        subset.rows = self.rows[np.array([name_to_idx[name] for name in names],dtype=np.int64)]
+        subset.filenames = list(names)
+        return subset
+
+
+def gather_rows(source,idxs,out=None):
+    # fancy indexed gather along the first axis of an array or ShardReader
+    if isinstance(source,ShardReader):
+        return source.get_batch(idxs,out)
+    return np.take(source,idxs,axis=0,out=out)
+
+def load_folder_imgs(img_folder):
+    imgs = []
+    filenames = []
+    for img_name in os.listdir(img_folder):
+        with Image.open(os.path.join(img_folder,img_name)) as img:
+            if img.mode == "RGB":
+                imgs.append(np.array(img))
+                filenames.append(img_name)
+    return np.stack(imgs),filenames
+
+def load_input_imgs(img_folder=INPUT_FOLDER,shard_folder=SHARD_FOLDER):
+    # returns all images as one [N,96,96,3] array, or a memory mapped ShardReader
+    # that indexes like one, along with their filenames
+    if has_shards(shard_folder):
+        reader = ShardReader(shard_folder)
+        return reader,list(reader.filenames)
+    return load_folder_imgs(img_folder)
+
+def pack_folder(img_folder,shard_folder):
+    with ShardWriter(shard_folder) as writer:
+        for img_name in sorted(os.listdir(img_folder)):
+            with Image.open(os.path.join(img_folder,img_name)) as img:
+                if img.mode == "RGB":
+                    writer.add(np.array(img),img_name)
+    return len(writer)
+
+if __name__ == "__main__":
+    print("packed {} images".format(pack_folder(INPUT_FOLDER,SHARD_FOLDER)))
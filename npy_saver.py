@@ -1,13 +1,16 @@
-import numpy as np
-import os
-import collections
 import tensorflow as tf
+from array_store import write_arrays,load_arrays
 
-
+# saves and restores a set of variables to and from one array_store container.
+# save_all fetches every variable in one sess.run. the placeholders and assign
+# ops load_all feeds are built the first time it runs, so repeated loads
+# never grow the graph. add every variable before the first load.
 class NpySaver:
     def __init__(self,folder):
         self.folder = folder
         self.tf_obj_dict = {}
+        self.placeholders = None
+        self.load_op = None
 
     def add(self,tf_obj,name=None):
         if name is None:
@@ -15,22 +18,30 @@ class NpySaver:
 
         if name in self.tf_obj_dict:
             raise RuntimeError("name already in saver, no duplicates allowed")
+        if self.load_op is not None:
+            raise RuntimeError("cannot add to a saver that has already loaded")
 
         self.tf_obj_dict[name] = tf_obj
 
-    def add_list(self,objs):
-        for obj in name_obj_pairs:
-            self.add(obj)
+    def add_list(self,name_obj_pairs):
+        # takes the (name,variable) pairs returned by the layer vars() methods
+        for name,obj in name_obj_pairs:
+            self.add(obj,name)
+
+    def build_load_op(self):
+        self.placeholders = {name:tf.placeholder(obj.dtype.base_dtype,obj.get_shape())
+                                for name,obj in self.tf_obj_dict.items()}
+        self.load_op = tf.group([tf.assign(obj,self.placeholders[name])
+                                for name,obj in self.tf_obj_dict.items()])
 
     def load_all(self,sess):
-        for name,obj in self.tf_obj_dict.items():
-            path = os.path.join(self.folder,name)
-            value = np.load(path)
-            assign = tf.assign(obj,value)
-            sess.run(assign)
+        if self.load_op is None:
+            self.build_load_op()
+        arrays = load_arrays(self.folder)
+        sess.run(self.load_op,feed_dict={
+            self.placeholders[name]:arrays[name] for name in self.tf_obj_dict
+        })
 
     def save_all(self,sess):
-        for name,obj in self.tf_obj_dict.items():
-            path = os.path.join(self.folder,name)
-            value = sess.run(obj)
-            np.save(path,value)
+        values = sess.run(self.tf_obj_dict)
+        write_arrays(self.folder,values)
@@ -5,13 +5,21 @@ import numpy as np
 from PIL import Image
 import random
 import shutil
-from base_ops import default_activ,Convpool2,Conv2d,Conv1x1,Conv1x1Upsample,ConvTrans2d,Convpool2,Deconv2,Dense
+from base_ops import default_activ,Convpool2,Conv2d,Conv1x1,Conv1x1Upsample,ConvTrans2d,Convpool2,Deconv2,Dense,SPECNORM_INTERVAL
 from quant_block import QuantBlockImg
 from npy_saver import NpySaver
+from async_checkpoint import AsyncCheckpointer
+from sample_export import SampleExporter
+from img_shards import load_input_imgs
+from batch_producer import BatchProducer,DatasetProducer,shuffled_batches,uint8_to_float,random_flip,compose
 
 BATCH_SIZE = 16
 BATCHS_PER_UPDATE = 8
 UPDATE_COUNT = 4
+# feed training batches through tf.data instead of the python batch queue
+USE_TF_DATA = False
+# random left/right flips, only applied by the tf.data pipeline
+AUGMENT_FLIP = False
 
 IMG_SIZE = (96,96)
 
@@ -244,10 +252,11 @@ class MainCalc:
     def calc_loss_single(self,true_imgs,hint_img):
         new_img = self.gen.calc(hint_img)
 
-        true_diffs = self.discrim.calc(true_imgs)
-        false_diffs = self.discrim.calc(new_img)
+        # real and generated images go through the discriminator as one double batch
+        all_diffs = self.discrim.calc(tf.concat([true_imgs,new_img],axis=0))
+        true_diffs = all_diffs[:BATCH_SIZE]
+        false_diffs = all_diffs[BATCH_SIZE:]
 
-        all_diffs = tf.concat([true_diffs,false_diffs],axis=0)
         diff_cmp = tf.concat([tf.ones_like(true_diffs),tf.zeros_like(false_diffs)],axis=0)
 
         diff_costs = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=all_diffs,labels=diff_cmp))
@@ -258,8 +267,23 @@ class MainCalc:
 
         return diff_costs,gen_cost,tf.stop_gradient(new_img),tf.stop_gradient(new_img_grad)
 
+    def initial_hint(self):
+        return tf.zeros([BATCH_SIZE,IMG_SIZE[0],IMG_SIZE[1],6])
+
+    def preview(self):
+        # the same UPDATE_COUNT gradient hint refinement steps as calc_updates,
+        # with the discriminator run on the generated images alone and no
+        # optimizer or gradient accumulation ops
+        cur_hint = self.initial_hint()
+        for i in range(UPDATE_COUNT):
+            new_img = self.gen.calc(cur_hint)
+            gen_cost = tf.reduce_mean(-self.discrim.calc(new_img))
+            new_img_grad = tf.gradients(ys=gen_cost,xs=new_img,stop_gradients=[cur_hint])[0]
+            cur_hint = tf.concat([tf.stop_gradient(new_img),tf.stop_gradient(new_img_grad)],axis=-1)
+        return new_img
+
     def calc_updates(self,true_imgs):
-        cur_hint = tf.zeros([BATCH_SIZE,IMG_SIZE[0],IMG_SIZE[1],6])
+        cur_hint = self.initial_hint()
 
         all_diff_costs = []
         all_gen_costs = []
@@ -290,8 +314,15 @@ class MainCalc:
 
 def main():
     mc = MainCalc()
-    true_img = tf.placeholder(shape=[BATCH_SIZE*UPDATE_COUNT,96,96,3],dtype=tf.uint8)
-    float_img = tf.cast(true_img,tf.float32) / 256.0
+    input_shapes = [[BATCH_SIZE*UPDATE_COUNT,96,96,3]]
+    if USE_TF_DATA:
+        map_fn = compose(random_flip,uint8_to_float) if AUGMENT_FLIP else uint8_to_float
+        producer = DatasetProducer(input_shapes,[tf.uint8],map_fn=map_fn)
+        float_img, = producer.dequeue()
+    else:
+        producer = BatchProducer(input_shapes,[tf.uint8])
+        true_img, = producer.dequeue()
+        float_img = tf.cast(true_img,tf.float32) / 256.0
 
     apply_op,add_op,init_op, diff_l, reconst_l,gen_img = mc.calc_updates(float_img)
     gen_img = tf.cast(gen_img*256.0,tf.uint8)
@@ -306,24 +337,22 @@ def main():
     apply_op = tf.group([apply_op]+batchnorm_updates)
     all_l_updates = tf.group(layer_updates)
 
-    orig_datas = []
-    full_names =  os.listdir("data/input_data/")
-    for img_name in full_names:
-        with Image.open("data/input_data/"+img_name) as img:
-            if img.mode == "RGB":
-                arr = np.array(img)
-                orig_datas.append((arr))
+    preview_pixels = tf.cast(mc.preview()*256.0,tf.uint8)
+    exporter = SampleExporter()
+
+    orig_datas,full_names = load_input_imgs()
 
 
     out_fold_names = full_names[:50]
 
     os.makedirs("data/prac_gen_result",exist_ok=True)
 
-    datas = [data for data in orig_datas]
+    datas = orig_datas
     saver = tf.train.Saver(max_to_keep=50)
     SAVE_DIR = "data/gen_save_model/"
     os.makedirs(SAVE_DIR,exist_ok=True)
     SAVE_NAME = SAVE_DIR+"model.ckpt"
+    checkpointer = AsyncCheckpointer(SAVE_NAME,max_to_keep=50)
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth=True
@@ -338,59 +367,46 @@ def main():
             print_num = int(checkpoint.split('-')[1])
             saver.restore(sess, checkpoint)
 
-        batch = []
+        if USE_TF_DATA:
+            producer.start(sess,(datas,))
+        else:
+            producer.start(sess,shuffled_batches((datas,),BATCH_SIZE*UPDATE_COUNT))
         batch_count = 0
         update_count = 0
+        tot_diff = 0
+        rec_loss = 0
+        loss_count = 0
         while True:
-            for x in range(20):
-                random.shuffle(datas)
-                tot_diff = 0
-                rec_loss = 0
-                loss_count = 0
-                for data in datas:
-                    batch.append(data)
-                    if len(batch) == BATCH_SIZE*UPDATE_COUNT:
-                        batch_count += 1
-                        img_batch = batch
-                        if batch_count % BATCHS_PER_UPDATE != 0:
-
-                            _ = sess.run(add_op,feed_dict={
-                                true_img:np.stack(img_batch),
-                            })
-                            batch = []
-                        else:
-                            update_count += 1
-                            _,dif_l,rec_l = sess.run([apply_op, diff_l, reconst_l],feed_dict={
-                                true_img:np.stack(img_batch),
-                            })
-                            sess.run(all_l_updates)
-                            sess.run(init_op)
-                            #print(sess.run(float_img))
-                            loss_count += 1
-                            tot_diff += dif_l
-                            rec_loss += rec_l
-                            batch = []
-
-                            EPOC_SIZE = 50
-                            if update_count % EPOC_SIZE == 0:
-                                print("epoc ended, loss: {}   {}".format(tot_diff/loss_count,rec_loss/loss_count),flush=True)
-                                lossval_num += 1
-
-                                tot_diff = 0
-                                rec_loss = 0
-                                loss_count = 0
-
-                                if update_count % (EPOC_SIZE*10) == 0:
-                                    print_num += 1
-                                    print("save {} started".format(print_num))
-                                    saver.save(sess,SAVE_NAME,global_step=print_num)
-                                    batch_outs = sess.run(gen_img)
-                                    for idx,out in enumerate(batch_outs):
-                                        #print(out.shape)
-                                        img = Image.fromarray(out)
-                                        img_path = "data/prac_gen_result/{}_{}.jpg".format(print_num,idx)
-                                        img.save(img_path)
-                                    print("save {} finished".format(print_num))
+            batch_count += 1
+            if batch_count % BATCHS_PER_UPDATE != 0:
+                _ = sess.run(add_op)
+            else:
+                update_count += 1
+                _,dif_l,rec_l = sess.run([apply_op, diff_l, reconst_l])
+                if update_count % SPECNORM_INTERVAL == 0:
+                    sess.run(all_l_updates)
+                sess.run(init_op)
+                #print(sess.run(float_img))
+                loss_count += 1
+                tot_diff += dif_l
+                rec_loss += rec_l
+
+                EPOC_SIZE = 50
+                if update_count % EPOC_SIZE == 0:
+                    print("epoc ended, loss: {}   {}".format(tot_diff/loss_count,rec_loss/loss_count),flush=True)
+                    lossval_num += 1
+
+                    tot_diff = 0
+                    rec_loss = 0
+                    loss_count = 0
+
+                    if update_count % (EPOC_SIZE*10) == 0:
+                        print_num += 1
+                        print("save {} started".format(print_num))
+                        checkpointer.save(sess,print_num)
+                        pixel_vals = sess.run(preview_pixels)
+                        exporter.submit(pixel_vals,["data/prac_gen_result/{}_{}.jpg".format(print_num,idx) for idx in range(len(pixel_vals))])
+                        print("save {} finished".format(print_num))
 
 if __name__ == "__main__":
     main()
@@ -1,17 +1,104 @@
 import os
+import sys
+import json
+import numpy as np
 from PIL import Image, ExifTags
 import multiprocessing
-import subprocess
+import functools
+import itertools
+import threading
+import queue
+from img_shards import ShardWriter,SHARD_FOLDER
 
+IMG_SIZE = 96
+# images handed to each pool worker at a time
+CHUNK_SIZE = 64
+# unconsumed chunks allowed per pool process
+CHUNKS_IN_FLIGHT = 4
+# completed images between manifest/index flushes
+FLUSH_EVERY = 1024
+MANIFEST_NAME = "manifest.jsonl"
+IMG_EXTENSIONS = (".jpg",".jpeg",".png",".bmp",".gif",".tif",".tiff",".webp")
+# threads walking top level directories during discovery, 1 scans serially
+SCAN_THREADS = 8
+# discovered paths buffered ahead of the pool
+SCAN_QUEUE_SIZE = 4096
+# filters for the final downscale to IMG_SIZE, selected by name
+RESAMPLE_FILTERS = {
+    "lanczos":Image.LANCZOS,
+    "bicubic":Image.BICUBIC,
+    "bilinear":Image.BILINEAR,
+    "box":Image.BOX,
+}
+RESAMPLE = "lanczos"
+# reduced jpeg decode keeps the short side at least IMG_SIZE*DRAFT_MARGIN
+DRAFT_MARGIN = 1
+# errors that mark a single source file as bad rather than ending the run
+BAD_IMAGE_ERRORS = (OSError,ValueError,Image.DecompressionBombError)
 
 
-def get_all_path_pairs(img_root,process_root):
-    cmd = ["find", ".", "-type", "f"]
-    out = subprocess.run(cmd,cwd=img_root,stdout=subprocess.PIPE).stdout
-    outlines = out.decode("utf-8").split("\n")
 
-    pair_paths = [((img_root+path),(process_root+path)) for path in outlines]
-    return pair_paths
+def has_extension(name,extensions):
+    return extensions is None or os.path.splitext(name)[1].lower() in extensions
+
+def scan_files(root,extensions=IMG_EXTENSIONS,rel_dir=""):
+    # iterative os.scandir walk, yields file paths relative to root as they are found
+    dir_stack = [rel_dir]
+    while dir_stack:
+        cur_dir = dir_stack.pop()
+        with os.scandir(os.path.join(root,cur_dir)) as entries:
+            for entry in entries:
+                rel_path = os.path.join(cur_dir,entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    dir_stack.append(rel_path)
+                elif entry.is_file() and has_extension(entry.name,extensions):
+                    yield rel_path
+
+def scan_files_parallel(root,extensions=IMG_EXTENSIONS,num_threads=SCAN_THREADS):
+    # top level directories are split between threads, scandir releases the gil
+    # while it waits on the filesystem so this helps most on network mounts
+    top_dirs = queue.Queue()
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                top_dirs.put(entry.name)
+            elif entry.is_file() and has_extension(entry.name,extensions):
+                yield entry.name
+
+    found = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    def scan_worker():
+        try:
+            while True:
+                try:
+                    top_dir = top_dirs.get_nowait()
+                except queue.Empty:
+                    break
+                for rel_path in scan_files(root,extensions,top_dir):
+                    found.put((rel_path,None))
+            found.put((None,None))
+        except OSError as err:
+            found.put((None,err))
+
+    for _ in range(num_threads):
+        threading.Thread(target=scan_worker,daemon=True).start()
+    finished = 0
+    while finished < num_threads:
+        rel_path,err = found.get()
+        if err is not None:
+            raise err
+        if rel_path is None:
+            finished += 1
+        else:
+            yield rel_path
+
+def get_all_rel_paths(img_root,extensions=IMG_EXTENSIONS,scan_threads=SCAN_THREADS):
+    if scan_threads > 1:
+        return scan_files_parallel(img_root,extensions,scan_threads)
+    return scan_files(img_root,extensions)
+
+def get_all_path_pairs(img_root,process_root,extensions=IMG_EXTENSIONS,scan_threads=SCAN_THREADS):
+    for rel_path in get_all_rel_paths(img_root,extensions,scan_threads):
+        yield os.path.join(img_root,rel_path),os.path.join(process_root,rel_path)
 
 
 def crop_to_square(img):
@@ -28,9 +115,12 @@ def crop_to_square(img):
         img = img.crop(area)
     return img
 
-def process(image_path,thumbnail_path):
+def thumbnail_location(thumbnail_path):
     thumbnail_path = os.path.abspath(thumbnail_path)
-    thumbnail_path = thumbnail_path.split(".")[0]+".jpg"
+    return thumbnail_path.split(".")[0]+".jpg"
+
+def process(image_path,thumbnail_path,resample=RESAMPLE):
+    thumbnail_path = thumbnail_location(thumbnail_path)
     os.makedirs(os.path.dirname(thumbnail_path),exist_ok=True)
     with Image.open(image_path) as img:
         '''for orientation in ExifTags.TAGS.keys():
@@ -49,35 +139,209 @@ def process(image_path,thumbnail_path):
         # the thumbnail will have dimensions of the same ratio as before, capped by
         # the limiting dimension of max_dim
         #print(img.size)
-        img = img.convert("RGB")
-        IMG_SIZE = 96
-        new_size = (IMG_SIZE,IMG_SIZE)
-        img = crop_to_square(img)
-        if img.size[0] > IMG_SIZE:
-            img.thumbnail(new_size, Image.ANTIALIAS)
-        else:
-            img = img.resize(new_size, Image.BICUBIC)
+        img = resize_img(img,resample)
         img.save(thumbnail_path,format="JPEG")
 
+def resize_img(img,resample=RESAMPLE):
+    # must be called before anything loads the pixels. jpegs are then decoded
+    # with dct scaling (1/2, 1/4 or 1/8) to the smallest size whose short side
+    # is still at least IMG_SIZE*DRAFT_MARGIN, other formats ignore the draft
+    draft_size = IMG_SIZE*DRAFT_MARGIN
+    img.draft("RGB",(draft_size,draft_size))
+    img = img.convert("RGB")
+    new_size = (IMG_SIZE,IMG_SIZE)
+    img = crop_to_square(img)
+    if img.size[0] > IMG_SIZE:
+        img = img.resize(new_size, RESAMPLE_FILTERS[resample])
+    else:
+        img = img.resize(new_size, Image.BICUBIC)
+    return img
+
+def process_to_array(image_path,resample=RESAMPLE):
+    with Image.open(image_path) as img:
+        img = resize_img(img,resample)
+        return np.asarray(img,dtype=np.uint8)
+
 def proc_pair(pair):
     return process(pair[0],pair[1])
 
+def proc_item(item,resample=RESAMPLE):
+    # item is (image_path,size,mtime,thumbnail_path), thumbnail_path is None for shard output
+    image_path,size,mtime,thumbnail_path = item
+    try:
+        if thumbnail_path is None:
+            return item,process_to_array(image_path,resample),None
+        process(image_path,thumbnail_path,resample)
+        return item,None,None
+    except BAD_IMAGE_ERRORS as err:
+        return item,None,"{}: {}".format(type(err).__name__,err)
+
+
+# append only record of every source file seen, so reruns only process
+# new or changed files and interrupted runs pick up where they stopped.
+# each line holds path, size, mtime, output location and status ("done" or "failed").
+class Manifest:
+    def __init__(self,process_root):
+        os.makedirs(process_root,exist_ok=True)
+        self.path = os.path.join(process_root,MANIFEST_NAME)
+        self.entries = {}
+        ends_cleanly = True
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    ends_cleanly = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partially written last line of an interrupted run
+                        continue
+                    self.entries[entry["path"]] = entry
+        self.file = open(self.path,'a')
+        if not ends_cleanly:
+            self.file.write("\n")
+
+    def is_current(self,path,size,mtime):
+        entry = self.entries.get(path)
+        return entry is not None and entry["size"] == size and entry["mtime"] == mtime
+
+    def record(self,path,size,mtime,output,status,error=None):
+        entry = {
+            "path":path,
+            "size":size,
+            "mtime":mtime,
+            "output":output,
+            "status":status,
+        }
+        if error is not None:
+            entry["error"] = error
+        self.entries[path] = entry
+        self.file.write(json.dumps(entry)+"\n")
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def pending_items(path_pairs,manifest):
+    for img_path,thumbnail_path in path_pairs:
+        stat = os.stat(img_path)
+        if not manifest.is_current(img_path,stat.st_size,stat.st_mtime_ns):
+            yield (img_path,stat.st_size,stat.st_mtime_ns,thumbnail_path)
+
+def get_all_paths(img_root,extensions=IMG_EXTENSIONS,scan_threads=SCAN_THREADS):
+    # paths are streamed lazily so the pool never sees a fully materialised list
+    for rel_path in get_all_rel_paths(img_root,extensions,scan_threads):
+        yield os.path.join(img_root,rel_path)
+
+def proc_chunk(items,resample=RESAMPLE):
+    return [proc_item(item,resample) for item in items]
+
+def run_pool(items,on_result,resample=RESAMPLE):
+    # chunks are pulled from items and submitted only while fewer than
+    # CHUNKS_IN_FLIGHT per process are unconsumed, so neither a fast scan
+    # nor a slow on_result can queue up more paths or decoded images
+    worker = functools.partial(proc_chunk,resample=resample)
+    num_procs = multiprocessing.cpu_count()
+    max_in_flight = num_procs*CHUNKS_IN_FLIGHT
+    items = iter(items)
+    done = queue.Queue()
+    in_flight = 0
+    exhausted = False
+    count = 0
+    failed = 0
+    with multiprocessing.Pool(processes=num_procs) as pool:
+        while True:
+            while not exhausted and in_flight < max_in_flight:
+                chunk = list(itertools.islice(items,CHUNK_SIZE))
+                if not chunk:
+                    exhausted = True
+                    break
+                pool.apply_async(worker,(chunk,),callback=done.put,error_callback=done.put)
+                in_flight += 1
+            if in_flight == 0:
+                break
+            results = done.get()
+            in_flight -= 1
+            if isinstance(results,BaseException):
+                raise results
+            for result in results:
+                if result[2] is not None:
+                    failed += 1
+                    print("skipped {}, {}".format(result[0][0],result[2]),flush=True)
+                on_result(count,result)
+                count += 1
+    return failed
+
+def write_thumbnails(path_pairs,process_root,resample=RESAMPLE):
+    with Manifest(process_root) as manifest:
+        def on_result(count,result):
+            (img_path,size,mtime,thumbnail_path),_,error = result
+            status = "done" if error is None else "failed"
+            manifest.record(img_path,size,mtime,thumbnail_location(thumbnail_path),status,error)
+            if count % FLUSH_EVERY == 0:
+                manifest.flush()
+
+        return run_pool(pending_items(path_pairs,manifest),on_result,resample)
+
+def write_shards(img_paths,img_root,shard_root,resample=RESAMPLE):
+    with Manifest(shard_root) as manifest, \
+            ShardWriter(shard_root,img_shape=(IMG_SIZE,IMG_SIZE,3),append=True) as writer:
+        # manifest lines are held back until the shard index covering them is on disk,
+        # so a resumed run never trusts pixels the index does not know about
+        unflushed = []
+        def on_result(count,result):
+            (img_path,size,mtime,_),arr,error = result
+            if error is None:
+                location = writer.add(arr,os.path.relpath(img_path,img_root))
+                unflushed.append((img_path,size,mtime,location,"done",None))
+            else:
+                # a changed file that no longer decodes must not leave its old pixels live
+                writer.remove(os.path.relpath(img_path,img_root))
+                unflushed.append((img_path,size,mtime,None,"failed",error))
+            if len(unflushed) >= FLUSH_EVERY:
+                flush()
+
+        def flush():
+            writer.flush()
+            for entry in unflushed:
+                manifest.record(*entry)
+            manifest.flush()
+            del unflushed[:]
+
+        items = pending_items(((path,None) for path in img_paths),manifest)
+        try:
+            failed = run_pool(items,on_result,resample)
+        finally:
+            flush()
+        return len(writer),failed
+
 def all():
     #img_root = "/home/ben/Downloads/img_net/"
     #process_root = "/home/ben/fun_projs/img_gen/data/image_net_64/"
     img_root = "/home/ben/fun_projs/img_gen/data/train2014/"
     process_root = "/home/ben/fun_projs/img_gen/data/coco96/"
     all_path_pairs = get_all_path_pairs(img_root,process_root)
-    #print(len(all_path_pairs))
-    print(all_path_pairs[:5])
-    #exit(0)
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    pool.map(proc_pair, all_path_pairs)
-    return
-    for pair in all_path_pairs:
-        try:
-            proc_pair(pair)
-        except OSError as ose:
-            print(pair)
-            raise ose
-all()
+    failed = write_thumbnails(all_path_pairs,process_root)
+    print("{} images failed, see {}".format(failed,os.path.join(process_root,MANIFEST_NAME)))
+
+def all_shards():
+    img_root = "/home/ben/fun_projs/img_gen/data/train2014/"
+    # the trainers read shards from SHARD_FOLDER under the project root
+    shard_root = "/home/ben/fun_projs/img_gen/"+SHARD_FOLDER
+    count,failed = write_shards(get_all_paths(img_root),img_root,shard_root)
+    print("{} images in shards, {} failed".format(count,failed))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "shards":
+        all_shards()
+    else:
+        all()
@@ -1,5 +1,7 @@
 
+import numpy as np
 import tensorflow as tf
+from codebook_index import build_coarse_index,default_num_coarse,cluster_capacity
 def sqr(x):
     return x * x
 
@@ -16,10 +18,131 @@ def distances(inputs,vecs):
              + sum_sqr_vecs)
     return dists
 
+# flattened input rows searched at once by nearest_codes. bounds the
+# [rows,NUM_QUANT,QUANT_SIZE] distance tensor independent of batch and resolution
+SEARCH_BLOCK_SIZE = 4096
+
+def exact_search(inputs,vecs,dist_scale):
+    return tf.argmin(distances(inputs,vecs)*dist_scale,axis=-1)
+
+def approx_search(inputs,vecs,dist_scale,centroids,members,num_probes):
+    # coarse to fine search. only the codes belonging to the num_probes nearest
+    # coarse centroids of each row are compared, see codebook_index.
+    # members is [NUM_QUANT,num_coarse,capacity] code indexes padded with -1
+    N,NUM_QUANT,QUANT_DIM = inputs.get_shape().as_list()
+    QUANT_SIZE = vecs.get_shape().as_list()[1]
+    _,num_coarse,capacity = members.get_shape().as_list()
+
+    _,probe_idxs = tf.nn.top_k(-distances(inputs,centroids),k=num_probes)
+    flat_probes = tf.range(NUM_QUANT)[:,tf.newaxis]*num_coarse + probe_idxs
+    cands = tf.gather(tf.reshape(members,[NUM_QUANT*num_coarse,capacity]),flat_probes)
+    cands = tf.reshape(cands,[N,NUM_QUANT,num_probes*capacity])
+    return rerank_candidates(inputs,vecs,dist_scale,cands)
+
+def rerank_candidates(inputs,vecs,dist_scale,cands):
+    # float32 argmin over a [N,NUM_QUANT,num_cands] list of candidate code
+    # indexes per row, -1 entries are skipped
+    N,NUM_QUANT,QUANT_DIM = inputs.get_shape().as_list()
+    QUANT_SIZE = vecs.get_shape().as_list()[1]
+    valid = cands >= 0
+    cands = tf.maximum(cands,0)
+
+    flat_cands = tf.range(NUM_QUANT,dtype=tf.int64)[:,tf.newaxis]*QUANT_SIZE + cands
+    cand_vecs = tf.gather(tf.reshape(vecs,[NUM_QUANT*QUANT_SIZE,QUANT_DIM]),flat_cands)
+    sum_sqr_vecs = tf.reshape(tf.reduce_sum(sqr(vecs),axis=-1),[NUM_QUANT*QUANT_SIZE])
+    cand_scale = tf.reshape(tf.broadcast_to(dist_scale,[NUM_QUANT,QUANT_SIZE]),[NUM_QUANT*QUANT_SIZE])
+    dists = (tf.reduce_sum(sqr(inputs),axis=-1,keepdims=True)
+             - 2 * tf.einsum("ijk,ijmk->ijm",inputs,cand_vecs)
+             + tf.gather(sum_sqr_vecs,flat_cands))
+    dists = dists * tf.gather(cand_scale,flat_cands)
+    dists = tf.where(valid,dists,tf.fill(tf.shape(dists),np.inf))
+    best = tf.argmin(dists,axis=-1)
+    return tf.batch_gather(cands,best[:,:,tf.newaxis])[:,:,0]
+
+# low precision distances pick this many candidates per row for the float32 recheck
+LOW_PRECISION_CANDIDATES = 4
+
+def low_precision_search(inputs,vecs,dist_scale,dtype=tf.float16,num_candidates=LOW_PRECISION_CANDIDATES):
+    # the [N,NUM_QUANT,QUANT_SIZE] input-codeword products, the bulk of the
+    # search, read dtype operands. the squared norms and the distance sums
+    # stay float32. tf1 has no matmul with a float32 output for dtype inputs,
+    # so the product accumulation is up to the kernel (the gpu float16 matmul
+    # accumulates in float32 by default). rounding only swaps near ties, so
+    # the nearest few candidates are compared again in float32
+    matmul_val = tf.einsum("ijk,jmk->ijm",tf.cast(inputs,dtype),tf.cast(vecs,dtype))
+    low_dists = (tf.reduce_sum(sqr(inputs),axis=-1,keepdims=True)
+                 - 2 * tf.cast(matmul_val,tf.float32)
+                 + tf.reduce_sum(sqr(vecs),axis=-1))
+    low_dists = low_dists*dist_scale
+    _,cands = tf.nn.top_k(-low_dists,k=min(num_candidates,vecs.get_shape().as_list()[1]))
+    return rerank_candidates(inputs,vecs,dist_scale,tf.cast(cands,tf.int64))
+
+_low_precision_errors = {}
+
+def check_low_precision_dtype(dtype):
+    # stock tf1 builds lack some low precision kernels, bfloat16 batched
+    # matmuls on gpu among them. runs the search's casts and einsum once per
+    # dtype in a throwaway session and raises ValueError if they have no
+    # kernel, rather than failing at the first training step
+    if dtype not in _low_precision_errors:
+        graph = tf.Graph()
+        with graph.as_default():
+            place = tf.placeholder(tf.float32,[1,1,2])
+            low = tf.cast(place,dtype)
+            out = tf.cast(tf.einsum("ijk,jmk->ijm",low,low),tf.float32)
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        try:
+            with tf.Session(graph=graph,config=config) as sess:
+                sess.run(out,feed_dict={place:np.ones([1,1,2],dtype=np.float32)})
+            _low_precision_errors[dtype] = None
+        except (tf.errors.NotFoundError,tf.errors.InvalidArgumentError,tf.errors.UnimplementedError) as err:
+            _low_precision_errors[dtype] = err.message
+    if _low_precision_errors[dtype] is not None:
+        raise ValueError("{} codeword search is not supported by this tensorflow build, use float16 or exact search: {}".format(
+            tf.as_dtype(dtype).name,_low_precision_errors[dtype]))
+
+def nearest_codes(inputs,vecs,dist_scale,block_size=SEARCH_BLOCK_SIZE,search_index=None):
+    # argmin of distances(inputs,vecs)*dist_scale, block_size rows at a time.
+    # each row is independent, so this picks the same codes as the unblocked argmin.
+    # with a search_index the argmin is approximated by its coarse to fine search
+    if search_index is None:
+        search = lambda rows: exact_search(rows,vecs,dist_scale)
+    else:
+        search = lambda rows: search_index.search(rows,vecs,dist_scale)
+    in_shape = inputs.get_shape().as_list()
+    num_rows = in_shape[0]
+    if block_size is None or num_rows <= block_size:
+        return search(inputs)
+    num_blocks = (num_rows+block_size-1) // block_size
+    padded = tf.pad(tf.stop_gradient(inputs),[[0,num_blocks*block_size-num_rows],[0,0],[0,0]])
+    blocks = tf.reshape(padded,[num_blocks,block_size]+in_shape[1:])
+
+    # parallel_iterations=1 keeps only one block of distances alive at a time
+    block_idxs = tf.map_fn(search,blocks,dtype=tf.int64,parallel_iterations=1,back_prop=False)
+    closest_idxs = tf.reshape(block_idxs,[num_blocks*block_size,in_shape[1]])
+    return closest_idxs[:num_rows]
+
+def flat_code_idxs(chosen_idxs,QUANT_SIZE):
+    # [N,NUM_QUANT] per codebook indexes to indexes into the flattened
+    # [NUM_QUANT*QUANT_SIZE] list of all codes
+    NUM_QUANT = chosen_idxs.get_shape().as_list()[1]
+    return tf.range(NUM_QUANT,dtype=chosen_idxs.dtype)*QUANT_SIZE + chosen_idxs
+
+def code_stats(div_input,chosen_idxs,QUANT_SIZE):
+    # usage counts [NUM_QUANT,QUANT_SIZE] and summed inputs [NUM_QUANT,QUANT_SIZE,QUANT_DIM]
+    # of every code, as segment sums over the chosen indexes rather than one-hot products
+    N,NUM_QUANT,QUANT_DIM = div_input.get_shape().as_list()
+    segment_ids = tf.reshape(flat_code_idxs(chosen_idxs,QUANT_SIZE),[N*NUM_QUANT])
+    num_segments = NUM_QUANT*QUANT_SIZE
+    counts = tf.unsorted_segment_sum(tf.ones([N*NUM_QUANT],dtype=tf.float32),segment_ids,num_segments)
+    sums = tf.unsorted_segment_sum(tf.reshape(div_input,[N*NUM_QUANT,QUANT_DIM]),segment_ids,num_segments)
+    return tf.reshape(counts,[NUM_QUANT,QUANT_SIZE]),tf.reshape(sums,[NUM_QUANT,QUANT_SIZE,QUANT_DIM])
+
 def gather_multi_idxs(qu_vecs,chosen_idxs):
     idx_shape = chosen_idxs.get_shape().as_list()
     qu_shape = qu_vecs.get_shape().as_list()
-    idx_add = tf.range(qu_shape[0],dtype=tf.int64)*qu_shape[1] + chosen_idxs
+    idx_add = flat_code_idxs(chosen_idxs,qu_shape[1])
     idx_transform = tf.reshape(idx_add,[prod(idx_shape)])
     rqu_vecs = tf.reshape(qu_vecs,[qu_shape[0]*qu_shape[1],qu_shape[2]])
 
@@ -30,13 +153,75 @@ def gather_multi_idxs(qu_vecs,chosen_idxs):
 
     return combined_vec_vals
 
-@tf.custom_gradient
-def quant_calc(qu_vecs,chosen_idxs,in_vecs):
-    closest_vec_values = gather_multi_idxs(qu_vecs,chosen_idxs)
+# coarse centroids probed per row by the approximate search
+APPROX_PROBES = 4
+
+# device copy of a codebook_index coarse index over one QuantBlock codebook.
+# rebuild() recomputes it on the host from the current codebook, through
+# assign ops built once here so rebuilding never grows the graph.
+class CodebookSearchIndex:
+    def __init__(self,QUANT_SIZE,NUM_QUANT,QUANT_DIM,num_coarse=None,num_probes=APPROX_PROBES):
+        self.num_coarse = default_num_coarse(QUANT_SIZE) if num_coarse is None else num_coarse
+        self.capacity = cluster_capacity(QUANT_SIZE,self.num_coarse)
+        self.num_probes = min(num_probes,self.num_coarse)
+        # derived from the codebook, so kept out of checkpoints as local variables.
+        # rebuild() must run after initialising or restoring the model
+        self.centroids = tf.Variable(tf.zeros([NUM_QUANT,self.num_coarse,QUANT_DIM]),name="search_centroids",
+                                        trainable=False,collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        self.members = tf.Variable(tf.fill([NUM_QUANT,self.num_coarse,self.capacity],tf.constant(-1,dtype=tf.int64)),name="search_members",
+                                        trainable=False,collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        self.centroid_place = tf.placeholder(tf.float32,self.centroids.get_shape())
+        self.member_place = tf.placeholder(tf.int64,self.members.get_shape())
+        self.assign_op = tf.group([
+            tf.assign(self.centroids,self.centroid_place),
+            tf.assign(self.members,self.member_place),
+        ])
+
+    def search(self,inputs,vecs,dist_scale):
+        return approx_search(inputs,vecs,dist_scale,self.centroids,self.members,self.num_probes)
 
+    def rebuild(self,sess,vectors):
+        codebook = sess.run(vectors)
+        centroids,members = build_coarse_index(codebook,self.num_coarse,self.capacity)
+        sess.run(self.assign_op,feed_dict={
+            self.centroid_place:centroids,
+            self.member_place:members,
+        })
+
+# exact search with low precision distances, same interface as CodebookSearchIndex
+class LowPrecisionSearch:
+    def __init__(self,dtype,num_candidates=LOW_PRECISION_CANDIDATES):
+        check_low_precision_dtype(dtype)
+        self.dtype = dtype
+        self.num_candidates = num_candidates
+
+    def search(self,inputs,vecs,dist_scale):
+        return low_precision_search(inputs,vecs,dist_scale,self.dtype,self.num_candidates)
+
+    def rebuild(self,sess,vectors):
+        pass
+
+LOW_PRECISION_MODES = {
+    "float16":tf.float16,
+    "bfloat16":tf.bfloat16,
+}
+
+def make_search_index(search_mode,QUANT_SIZE,NUM_QUANT,QUANT_DIM):
+    if search_mode == "exact":
+        return None
+    elif search_mode == "approx":
+        return CodebookSearchIndex(QUANT_SIZE,NUM_QUANT,QUANT_DIM)
+    elif search_mode in LOW_PRECISION_MODES:
+        return LowPrecisionSearch(LOW_PRECISION_MODES[search_mode])
+    else:
+        raise ValueError("unknown search mode: "+search_mode)
+
+@tf.custom_gradient
+def quant_calc(closest_vec_values,in_vecs):
+    # forwards the already gathered codes, passes the gradient straight through to the input
     def grad(dy):
-        return tf.zeros_like(qu_vecs),tf.zeros_like(chosen_idxs),dy
-    return closest_vec_values,grad
+        return tf.zeros_like(closest_vec_values),dy
+    return tf.identity(closest_vec_values),grad
 
 def assign_moving_average(var,cur_val,decay):
     new_var = var * decay + cur_val * (1-decay)
@@ -46,11 +231,21 @@ def assign_moving_average(var,cur_val,decay):
     return new_var,update
 
 
+# vector_counts holds a per step usage ema with this decay
+USAGE_DECAY = 0.99
+# codes whose usage falls below this fraction of the mean usage are dead
+DEAD_FRACTION = 0.01
+# recent encoder outputs kept per codebook to reseed dead codes from
+RESERVOIR_SIZE = 1024
+
 class QuantBlock:
-    def __init__(self,QUANT_SIZE,NUM_QUANT,QUANT_DIM):
+    def __init__(self,QUANT_SIZE,NUM_QUANT,QUANT_DIM,search_block_size=SEARCH_BLOCK_SIZE,search_mode="exact"):
         init_vals = tf.random_normal([NUM_QUANT,QUANT_SIZE,QUANT_DIM],dtype=tf.float32)
         self.vectors = tf.Variable(init_vals,name="vecs")
         self.vector_counts = tf.Variable(tf.zeros(shape=[NUM_QUANT,QUANT_SIZE],dtype=tf.float32),name="vecs")
+        # refilled from every batch, so kept out of checkpoints as a local variable
+        self.recent_inputs = tf.Variable(tf.zeros([NUM_QUANT,RESERVOIR_SIZE,QUANT_DIM],dtype=tf.float32),name="recent_inputs",
+                                            trainable=False,collections=[tf.GraphKeys.LOCAL_VARIABLES])
 
         self._ema_cluster_size = tf.Variable(tf.zeros([NUM_QUANT,QUANT_SIZE],dtype=tf.float32))
         #ema_init = tf.reshape(init_vals,[QUANT_SIZE,QUANT_DIM])
@@ -61,39 +256,35 @@ class QuantBlock:
         self.NUM_QUANT = NUM_QUANT
         self._decay = 0.9
         self._epsilon=1e-5
+        self.search_block_size = search_block_size
+        # "approx" searches through a coarse index, rebuild it with rebuild_search_index.
+        # "float16" and "bfloat16" compute the distances in low precision
+        self.search_index = make_search_index(search_mode,QUANT_SIZE,NUM_QUANT,QUANT_DIM)
 
     def calc(self, input):
         orig_size = input.get_shape().as_list()
         div_input = tf.reshape(input,[orig_size[0],self.NUM_QUANT,self.QUANT_DIM])
-        #dists = tf.einsum("ijk,jmk->ijm",div_input,self.vectors)
-        dists = distances(div_input,self.vectors)
         #cluster_size = tf.reshape(,[self.QUANT_SIZE])
-        dists = dists * (1.0+(tf.sqrt(self._ema_cluster_size)))
+        dist_scale = 1.0+(tf.sqrt(self._ema_cluster_size))
 
-        #dists = distances(input,self.vectors)
         #soft_vals = tf.softmax(,axis=1)
         #inv_dists = 1.0/(dists+0.000001)
         #closest_vec_idx = tf.multinomial((inv_dists),1)
         #closest_vec_idx = tf.reshape(closest_vec_idx,shape=[closest_vec_idx.get_shape().as_list()[0]])
         #print(closest_vec_idx.shape)
-        closest_vec_idx = tf.argmin(dists,axis=-1)
+        closest_vec_idx = nearest_codes(div_input,self.vectors,dist_scale,self.search_block_size,self.search_index)
 
-        out_val = quant_calc(self.vectors,closest_vec_idx,input)
-        other_losses, update = self.calc_other_vals(input,closest_vec_idx)
+        # single pass: the reshaped input and the gathered codes are shared by
+        # the output, the commitment loss and the codebook statistics
+        closest_vec_values = gather_multi_idxs(self.vectors,closest_vec_idx)
+        out_val = quant_calc(closest_vec_values,input)
+        other_losses, update = self.calc_other_vals(input,div_input,closest_vec_idx,closest_vec_values)
         return out_val, other_losses, update,closest_vec_idx
 
-    def codebook_update(self,input,closest_vec_idxs):
-        #BATCH_SIZE = input.get_shape().as_list()[0]
-        #closest_vec_idxs = tf.reshape(closest_vec_idxs,[BATCH_SIZE,])
-        closest_vec_onehots = tf.one_hot(closest_vec_idxs,self.QUANT_SIZE)
-
+    def codebook_update(self,counts,dw):
+        # counts and dw are the per code usage counts and input sums from code_stats
         updated_ema_cluster_size,cluster_update = assign_moving_average(
-          self._ema_cluster_size, tf.reduce_sum(closest_vec_onehots, axis=0), self._decay)
-        dw = tf.einsum("ijk,ijm->jmk",input,closest_vec_onehots)#tf.matmul(input, closest_vec_onehots, transpose_a=True)
-        #dw = tf.transpose(dw)
-        #print(dw)
-        #dw = closest_vec_vals
-        #exit(0)
+          self._ema_cluster_size, counts, self._decay)
         updated_ema_w,ema_w_update = assign_moving_average(self._ema_w, dw,
                                                             self._decay)
         n = tf.reduce_sum(updated_ema_cluster_size)
@@ -109,34 +300,55 @@ class QuantBlock:
         all_updates = tf.group([update_w,ema_w_update,cluster_update])
         return all_updates#all_updates
 
-    def calc_other_vals(self,input,closest_vec_idx):
-        closest_vec_values = gather_multi_idxs(self.vectors,closest_vec_idx)
-
+    def calc_other_vals(self,input,div_input,closest_vec_idx,closest_vec_values):
         #codebook_loss = tf.reduce_sum(sqr(closest_vec_values - tf.stop_gradient(input)))
         orig_size = input.get_shape().as_list()
-        div_input = tf.reshape(input,[orig_size[0],self.NUM_QUANT,self.QUANT_DIM])
-        codebook_update = self.codebook_update(div_input,closest_vec_idx)
+        counts,dw = code_stats(div_input,closest_vec_idx,self.QUANT_SIZE)
+        codebook_update = self.codebook_update(counts,dw)
 
         beta_val = 0.25 #from https://arxiv.org/pdf/1906.00446.pdf
         commitment_loss = tf.reduce_sum(beta_val * sqr(tf.stop_gradient(closest_vec_values) - input))
 
-        idx_one_hot = tf.one_hot(closest_vec_idx,self.QUANT_SIZE)
-        total = tf.reduce_sum(idx_one_hot,axis=0)
-        update_counts = tf.assign(self.vector_counts,self.vector_counts+total)
-        combined_update = tf.group([codebook_update,update_counts])
+        update_counts = tf.assign(self.vector_counts,self.vector_counts*USAGE_DECAY + counts*(1-USAGE_DECAY))
+        sample_idxs = tf.random.uniform([RESERVOIR_SIZE],0,orig_size[0],dtype=tf.int32)
+        samples = tf.transpose(tf.gather(div_input,sample_idxs),[1,0,2])
+        update_recent = tf.assign(self.recent_inputs,samples)
+        combined_update = tf.group([codebook_update,update_counts,update_recent])
 
         return commitment_loss ,combined_update
 
+    def rebuild_search_index(self,sess):
+        if self.search_index is not None:
+            self.search_index.rebuild(sess,self.vectors)
+
+    def dead_codes(self):
+        mean_usage = tf.reduce_mean(self.vector_counts,axis=1,keepdims=True)
+        return self.vector_counts < DEAD_FRACTION * mean_usage
+
+    def summary(self):
+        # total dead codes and the per codebook perplexity of the usage ema
+        dead_count = tf.reduce_sum(tf.cast(self.dead_codes(),tf.int32))
+        probs = self.vector_counts / (tf.reduce_sum(self.vector_counts,axis=1,keepdims=True)+1e-10)
+        perplexity = tf.exp(-tf.reduce_sum(probs*tf.log(probs+1e-10),axis=1))
+        return dead_count,perplexity
+
     def resample_bad_vecs(self):
-        sample_vals = tf.random_normal([self.NUM_QUANT,self.QUANT_SIZE,self.QUANT_DIM],dtype=tf.float32)
-        equal_vals = tf.cast(tf.equal(self.vector_counts,0),dtype=tf.float32)
-        equal_vals= tf.reshape(equal_vals,shape=[self.NUM_QUANT,self.QUANT_SIZE,1])
-        new_vecs = self.vectors - self.vectors * equal_vals + sample_vals * equal_vals
+        # reseeds dead codes with random recent encoder outputs, entirely on device.
+        # reseeded codes restart at the mean usage so they are not judged dead
+        # again before they have had a chance to be picked
+        dead = self.dead_codes()
+        pick = tf.random.uniform([self.NUM_QUANT,self.QUANT_SIZE],0,RESERVOIR_SIZE,dtype=tf.int32)
+        flat_pick = tf.range(self.NUM_QUANT)[:,tf.newaxis]*RESERVOIR_SIZE + pick
+        seeds = tf.gather(tf.reshape(self.recent_inputs,[self.NUM_QUANT*RESERVOIR_SIZE,self.QUANT_DIM]),flat_pick)
+        dead_vecs = tf.tile(dead[:,:,tf.newaxis],[1,1,self.QUANT_DIM])
+        new_vecs = tf.where(dead_vecs,seeds,self.vectors)
+        mean_usage = tf.broadcast_to(tf.reduce_mean(self.vector_counts,axis=1,keepdims=True),[self.NUM_QUANT,self.QUANT_SIZE])
         vec_assign = tf.assign(self.vectors,new_vecs)
-        ema_assign = tf.assign(self._ema_w,new_vecs)
-        zero_assign = tf.assign(self.vector_counts,tf.zeros_like(self.vector_counts))
-        tot_assign = tf.group([vec_assign,zero_assign,ema_assign])
-        return zero_assign#tot_assign
+        ema_assign = tf.assign(self._ema_w,tf.where(dead_vecs,seeds,self._ema_w))
+        cluster_assign = tf.assign(self._ema_cluster_size,tf.where(dead,tf.ones_like(self._ema_cluster_size),self._ema_cluster_size))
+        usage_assign = tf.assign(self.vector_counts,tf.where(dead,mean_usage,self.vector_counts))
+        tot_assign = tf.group([vec_assign,ema_assign,cluster_assign,usage_assign])
+        return tot_assign
 
     def vars(self,name):
         return [
@@ -152,10 +364,22 @@ def prod(l):
     return p
 
 class QuantBlockImg(QuantBlock):
+    def __init__(self,QUANT_SIZE,NUM_QUANT,QUANT_DIM,search_block_size=SEARCH_BLOCK_SIZE,search_mode="exact",data_format="NHWC"):
+        QuantBlock.__init__(self,QUANT_SIZE,NUM_QUANT,QUANT_DIM,search_block_size,search_mode)
+        self.data_format = data_format
+
     def calc(self,input):
+        # codes are always returned as [B,H,W,NUM_QUANT], whatever the data format.
+        # the search, gathers and segment sums all work on contiguous codeword
+        # rows, which NCHW strides across the feature map, so an NCHW input is
+        # quantized through an NHWC view: one transpose in and one out per block
+        if self.data_format == "NCHW":
+            input = tf.transpose(input,[0,2,3,1])
         in_shape = input.get_shape().as_list()
         flat_val = tf.reshape(input,[prod(in_shape[:3]),in_shape[3]])
         out,o1,o2,closest = QuantBlock.calc(self,flat_val)
         restored = tf.reshape(out,in_shape)
+        if self.data_format == "NCHW":
+            restored = tf.transpose(restored,[0,3,1,2])
         resh_closest = tf.reshape(closest,[in_shape[0],in_shape[1],in_shape[2],closest.shape[1]])
         return restored,o1,o2,resh_closest
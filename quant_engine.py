@@ -0,0 +1,64 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from array_store import load_arrays
+
+# numpy port of the QuantBlock codeword search and lookup, for bulk encoding
+# and decoding on machines without tensorflow. codebooks come from
+# train_passthrough.export_codebooks
+
+CODEBOOK_FOLDER = "data/codebooks/"
+# rows per block, bounds the [rows,NUM_QUANT,QUANT_SIZE] distance array
+BLOCK_SIZE = 4096
+
+def codebook_names(name):
+    return name+"_vecs",name+"_cluster_size"
+
+class NumpyQuantizer:
+    def __init__(self,vectors,cluster_size=None,block_size=BLOCK_SIZE,num_threads=None):
+        # vectors is [NUM_QUANT,QUANT_SIZE,QUANT_DIM], cluster_size the [NUM_QUANT,QUANT_SIZE]
+        # ema cluster sizes that QuantBlock.calc scales its distances by
+        self.vectors = np.ascontiguousarray(vectors,dtype=np.float32)
+        self.NUM_QUANT,self.QUANT_SIZE,self.QUANT_DIM = self.vectors.shape
+        if cluster_size is None:
+            self.dist_scale = np.ones([self.NUM_QUANT,self.QUANT_SIZE],dtype=np.float32)
+        else:
+            self.dist_scale = (1.0+np.sqrt(cluster_size)).astype(np.float32)
+        self.sum_sqr_vecs = np.sum(self.vectors*self.vectors,axis=-1)
+        self.vecs_t = np.ascontiguousarray(self.vectors.transpose(0,2,1))
+        self.block_size = block_size
+        self.num_threads = os.cpu_count() if num_threads is None else num_threads
+
+    @classmethod
+    def load(cls,name,folder=CODEBOOK_FOLDER,**kwargs):
+        vecs_name,cluster_name = codebook_names(name)
+        arrays = load_arrays(folder)
+        return cls(arrays[vecs_name],arrays.get(cluster_name),**kwargs)
+
+    def encode_block(self,rows):
+        # rows is [N,NUM_QUANT,QUANT_DIM], same expression as quant_block.distances
+        by_quant = rows.transpose(1,0,2)
+        dists = (np.sum(by_quant*by_quant,axis=-1,keepdims=True)
+                 - 2 * np.matmul(by_quant,self.vecs_t)
+                 + self.sum_sqr_vecs[:,np.newaxis,:])
+        dists *= self.dist_scale[:,np.newaxis,:]
+        return np.argmin(dists,axis=-1).T
+
+    def encode(self,inputs):
+        # inputs is [...,NUM_QUANT*QUANT_DIM] (e.g. a [B,H,W,C] feature map),
+        # returns the [...,NUM_QUANT] chosen code indexes
+        lead_shape = inputs.shape[:-1]
+        rows = np.asarray(inputs,dtype=np.float32).reshape([-1,self.NUM_QUANT,self.QUANT_DIM])
+        starts = range(0,len(rows),self.block_size)
+        # numpy releases the gil inside matmul, so blocks run in parallel on threads
+        with ThreadPoolExecutor(self.num_threads) as pool:
+            blocks = list(pool.map(lambda start: self.encode_block(rows[start:start+self.block_size]),starts))
+        codes = np.concatenate(blocks,axis=0) if blocks else np.zeros([0,self.NUM_QUANT],dtype=np.int64)
+        return codes.reshape(lead_shape+(self.NUM_QUANT,))
+
+    def decode(self,codes):
+        # inverse lookup, [...,NUM_QUANT] code indexes to [...,NUM_QUANT*QUANT_DIM]
+        # vectors, like quant_block.gather_multi_idxs
+        codes = np.asarray(codes,dtype=np.int64)
+        vecs = self.vectors[np.arange(self.NUM_QUANT),codes]
+        return vecs.reshape(codes.shape[:-1]+(self.NUM_QUANT*self.QUANT_DIM,))
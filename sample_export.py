@@ -0,0 +1,27 @@
+from PIL import Image
+from async_worker import AsyncWorker
+
+# jpeg encoding runs in PIL's C code with the gil released, so a few threads
+# write preview images in parallel with each other and with training
+EXPORT_THREADS = 4
+
+def save_image(pixels,path):
+    Image.fromarray(pixels).save(path)
+
+# writes preview images from a thread pool so the training loop only waits
+# for the preview forward pass. submit() blocks once max_pending images are
+# queued, which bounds the memory held by a slow disk.
+class SampleExporter:
+    def __init__(self,num_threads=EXPORT_THREADS,max_pending=256):
+        self.worker = AsyncWorker(num_threads=num_threads,max_pending=max_pending)
+
+    def submit(self,pixel_batch,paths):
+        # pixel_batch is a [B,H,W,3] uint8 array, one path per image
+        for pixels,path in zip(pixel_batch,paths):
+            self.worker.submit(save_image,pixels,path)
+
+    def wait(self):
+        self.worker.wait()
+
+    def close(self):
+        self.worker.close()
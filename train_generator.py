@@ -5,11 +5,18 @@ import numpy as np
 from PIL import Image
 import random
 import shutil
-from base_ops import default_activ,Convpool2,Conv2d,Conv1x1,Conv1x1Upsample,ConvTrans2d,Convpool2,Deconv2
+from base_ops import default_activ,Convpool2,Conv2d,Conv1x1,Conv1x1Upsample,ConvTrans2d,Convpool2,Deconv2,SPECNORM_INTERVAL
 from quant_block import QuantBlockImg
 from npy_saver import NpySaver
+from async_checkpoint import AsyncCheckpointer
+from sample_export import SampleExporter
+from img_shards import ShardReader,has_shards,SHARD_FOLDER
+from code_store import load_codes,load_names,CODES_FOLDER
+from batch_producer import BatchProducer,DatasetProducer,shuffled_batches,uint8_to_float
 
 BATCH_SIZE = 32
+# feed training batches through tf.data instead of the python batch queue
+USE_TF_DATA = False
 
 IMG_SIZE = (96,96)
 
@@ -55,6 +62,15 @@ FOURTH_LEVEL = 192
 FIFTH_LEVEL = 256
 ZIXTH_LEVEL = 256
 
+def batched_discrim(discrim,true_imgs,fake_imgs,repr_feats):
+    # one pass of the image branch over the real and generated images stacked
+    # into a double batch, split back into the (sum,all) outputs of each half.
+    # repr_feats is the output of discrim.calc_repr, shared by both halves
+    batch_size = true_imgs.get_shape().as_list()[0]
+    both_repr_feats = [tf.concat([feat,feat],axis=0) for feat in repr_feats]
+    both_sum,both_all = discrim.join(discrim.calc_img(tf.concat([true_imgs,fake_imgs],axis=0)),both_repr_feats)
+    return (both_sum[:batch_size],both_all[:batch_size]),(both_sum[batch_size:],both_all[batch_size:])
+
 class Discrim:
     def __init__(self):
         self.convpool1img = Convpool2(3,IMG_LEVEL,default_activ)
@@ -86,7 +102,7 @@ class Discrim:
             self.convpool4repr.updates()
         )
 
-    def calc(self,img,repr):
+    def calc_img(self,img):
         cur_img_out = img
         cur_img_out = self.convpool1img.calc(cur_img_out)
         diff1 = self.diff1img.calc(cur_img_out)
@@ -98,13 +114,19 @@ class Discrim:
         cur_img_out = self.convpool4img.calc(cur_img_out)
         diff4 = self.diff4img.calc(cur_img_out)
         l4img = self.gather4img.calc(cur_img_out)
+        return diff1,diff2,diff3,diff4,l3img,l4img
 
+    def calc_repr(self,repr):
         cur_repr_out = repr
         cur_repr_out = self.convpool3repr.calc(cur_repr_out)
         repr3out = self.gather3repr.calc(cur_repr_out)
         cur_repr_out = self.convpool4repr.calc(cur_repr_out)
         repr4out = self.gather4repr.calc(cur_repr_out)
+        return repr3out,repr4out
 
+    def join(self,img_feats,repr_feats):
+        diff1,diff2,diff3,diff4,l3img,l4img = img_feats
+        repr3out,repr4out = repr_feats
         all_diffs = [
             calc_diff(diff1),
             calc_diff(diff2),
@@ -119,6 +141,9 @@ class Discrim:
         concatted_all = tf.concat(flattened_all,axis=1)
         return sum,concatted_all # tf.concat([full_flatten(diff3),full_flatten(diff4)],axis=0)
 
+    def calc(self,img,repr):
+        return self.join(self.calc_img(img),self.calc_repr(repr))
+
     def vars(self):
         var_names = (
             self.convpool1img.vars("") +
@@ -222,16 +247,33 @@ class MainCalc:
     def updates(self):
         return self.discrim.updates() #+ self.gen.updates()
 
-    def calc_loss(self,true_imgs,old_img,repr_idxs):
+    def repr_onehot(self,repr_idxs):
         REPR_SIZE = 2
         REPR_DEPTH = 128
         repr = tf.one_hot(repr_idxs,depth=REPR_DEPTH)
-        repr = tf.reshape(repr,[BATCH_SIZE]+get_out_shape(3)+[REPR_DEPTH*REPR_SIZE])
-
+        return tf.reshape(repr,[BATCH_SIZE]+get_out_shape(3)+[REPR_DEPTH*REPR_SIZE])
+
+    def initial_img(self):
+        # blank image with a flat gradient, the input of the first refinement step
+        img_shape = [BATCH_SIZE,IMG_SIZE[0],IMG_SIZE[1],3]
+        return tf.concat([tf.zeros(img_shape),tf.ones(img_shape)],axis=3)
+
+    def preview(self,repr_idxs):
+        # first refinement step only, with no discriminator, loss or optimizer ops
+        return self.gen.calc(self.initial_img(),self.repr_onehot(repr_idxs))
+
+    def calc_loss(self,true_imgs,true_diffs,old_img,repr,repr_feats,repr_idxs):
+        # true_diffs is the discriminator output on true_imgs and repr_feats its
+        # repr branch output, neither changes between refinement steps. pass
+        # true_diffs None on the first step to compute it in the same batched
+        # pass as the generated images
         new_img = self.gen.calc(old_img,repr)
 
-        true_diffs_sum,true_diffs_all = self.discrim.calc(true_imgs,repr)
-        false_diffs_sum,false_diffs_all = self.discrim.calc(new_img,repr)
+        if true_diffs is None:
+            true_diffs,(false_diffs_sum,false_diffs_all) = batched_discrim(self.discrim,true_imgs,new_img,repr_feats)
+        else:
+            false_diffs_sum,false_diffs_all = self.discrim.join(self.discrim.calc_img(new_img),repr_feats)
+        true_diffs_sum,true_diffs_all = true_diffs
 
         all_diffs_sum = tf.concat([true_diffs_sum,false_diffs_sum],axis=0)
         all_diffs_all = tf.concat([true_diffs_all,false_diffs_all],axis=0)
@@ -245,42 +287,54 @@ class MainCalc:
         reconstr_l = 0.1*tf.reduce_mean(sqr(new_img - true_imgs))
         disting_costs = -0.9*tf.reduce_mean(false_diffs_sum)-0.1*tf.reduce_mean(false_diffs_all)
 
-        minimize_discrim_op = self.discrim_optim.minimize(diff_costs,var_list=self.discrim.vars())
-        minimize_gen_op = self.gen_optim.minimize(disting_costs,var_list=self.gen.vars())
-
-        minimize_op = tf.group([minimize_gen_op,minimize_discrim_op])
-
         new_img_grad = tf.gradients(ys=disting_costs,xs=new_img,stop_gradients=[old_img,repr_idxs])[0]
         new_img_grad = tf.stop_gradient(new_img_grad)#self.bn_grads(new_img_grad))
 
-        return minimize_op,tf.stop_gradient(new_img),new_img_grad,reconstr_l,disting_costs,diff_costs
+        return tf.stop_gradient(new_img),new_img_grad,reconstr_l,disting_costs,diff_costs,true_diffs
 
     def recursive_calc(self,true_imgs,repr_idxs):
-        cur_old_img = tf.concat([tf.zeros_like(true_imgs),tf.ones_like(true_imgs)],axis=3)
+        # the refinement steps are unrolled, each one fed the stopped image and
+        # gradient hint of the last. their losses are averaged and minimized
+        # once, so there is a single gradient computation and optimizer update
+        # per network per step
+        repr = self.repr_onehot(repr_idxs)
+        repr_feats = self.discrim.calc_repr(repr)
+        true_diffs = None
+        cur_old_img = self.initial_img()
         all_reconstr_l = tf.zeros(1)
         all_diff_l = tf.zeros(1)
         all_disting_l = tf.zeros(1)
 
         ITERS = 3
-        all_updates = []
         for x in range(ITERS):
-            minimize_op,new_img,new_img_grad,reconstr_l,disting_l,diff_costs = self.calc_loss(true_imgs,cur_old_img,repr_idxs)
+            new_img,new_img_grad,reconstr_l,disting_l,diff_costs,true_diffs = self.calc_loss(true_imgs,true_diffs,cur_old_img,repr,repr_feats,repr_idxs)
             cur_old_img = tf.concat([new_img,new_img_grad],axis=3)
             all_reconstr_l += reconstr_l
             all_diff_l += diff_costs
             all_disting_l += disting_l
-            all_updates.append(minimize_op)
             if x == 0:
                 first_new_img = new_img
 
-        return tf.group(all_updates),all_diff_l[0]/ITERS,all_disting_l[0]/ITERS,all_reconstr_l[0]/ITERS,first_new_img
+        diff_l = all_diff_l[0]/ITERS
+        disting_l = all_disting_l[0]/ITERS
+        minimize_discrim_op = self.discrim_optim.minimize(diff_l,var_list=self.discrim.vars())
+        minimize_gen_op = self.gen_optim.minimize(disting_l,var_list=self.gen.vars())
+        minimize_op = tf.group([minimize_gen_op,minimize_discrim_op])
+
+        return minimize_op,diff_l,disting_l,all_reconstr_l[0]/ITERS,first_new_img
 
 
 def main():
     mc = MainCalc()
-    true_img = tf.placeholder(shape=[BATCH_SIZE,96,96,3],dtype=tf.uint8)
-    float_img = tf.cast(true_img,tf.float32) / 256.0
-    cmp_idxs = tf.placeholder(shape=[BATCH_SIZE]+get_out_shape(3)+[2],dtype=tf.uint16)
+    input_shapes = [[BATCH_SIZE,96,96,3],[BATCH_SIZE]+get_out_shape(3)+[2]]
+    if USE_TF_DATA:
+        # no flips here, they would misalign images with their codes
+        producer = DatasetProducer(input_shapes,[tf.uint8,tf.uint16],map_fn=uint8_to_float)
+        float_img,cmp_idxs = producer.dequeue()
+    else:
+        producer = BatchProducer(input_shapes,[tf.uint8,tf.uint16])
+        true_img,cmp_idxs = producer.dequeue()
+        float_img = tf.cast(true_img,tf.float32) / 256.0
     cmp_idx32 = tf.cast(cmp_idxs,tf.int32)
 
     mc_update, diff_l, disting_l, reconst_l, final_img = mc.recursive_calc(float_img,cmp_idx32)
@@ -291,31 +345,44 @@ def main():
 
     batchnorm_updates = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     print(batchnorm_updates)
-    layer_updates = mc.updates()
-    mc_update = tf.group([mc_update]+batchnorm_updates+layer_updates)
-
-    orig_datas = []
-    full_names =  os.listdir("data/pretrained_result/")
-    for img_name in full_names:
-        with Image.open("data/input_data/"+img_name+".jpg") as img:
-            #if img.mode == "RGB":
-            arr = np.array(img)
-            repr = np.load("data/pretrained_result/"+img_name+"/closest1.npy")
-            orig_datas.append((arr,repr))
-
-
-    out_fold_names = full_names[:max(BATCH_SIZE,50)]
-
-    for fold,fname in zip(out_fold_names,full_names):
+    layer_updates = tf.group(mc.updates())
+    mc_update = tf.group([mc_update]+batchnorm_updates)
+
+    preview_idxs = tf.placeholder(tf.uint16,input_shapes[1])
+    preview_pixels = tf.cast(mc.preview(tf.cast(preview_idxs,tf.int32))*256.0,tf.uint8)
+    exporter = SampleExporter()
+
+    full_names = load_names(CODES_FOLDER)
+    reprs = load_codes(CODES_FOLDER,1)
+    if has_shards(SHARD_FOLDER):
+        # stays memory mapped, row i of imgs is the image of code row i.
+        # codes computed before the shards last changed raise a ValueError,
+        # rerun train_passthrough.calc_closest_vals to recompute them
+        imgs = ShardReader(SHARD_FOLDER).select(full_names)
+    else:
+        img_list = []
+        for img_name in full_names:
+            with Image.open("data/input_data/"+img_name) as img:
+                #if img.mode == "RGB":
+                img_list.append(np.array(img))
+        imgs = np.stack(img_list)
+
+
+    out_fold_names = [fname.split('.')[0] for fname in full_names[:max(BATCH_SIZE,50)]]
+
+    # reference images come from the loaded pixels, so a shard only setup
+    # needs no decoded image folder
+    for idx,fold in enumerate(out_fold_names):
         fold_path = "data/gen_result/"+fold + "/"
         os.makedirs(fold_path,exist_ok=True)
-        shutil.copy("data/input_data/"+fname+".jpg",fold_path+"orig.jpg")
+        Image.fromarray(imgs[idx]).save(fold_path+"orig.jpg")
 
-    datas = [data for data in orig_datas]
+    datas = (imgs,reprs)
     saver = tf.train.Saver(max_to_keep=50)
     SAVE_DIR = "data/gen_save_model/"
     os.makedirs(SAVE_DIR,exist_ok=True)
     SAVE_NAME = SAVE_DIR+"model.ckpt"
+    checkpointer = AsyncCheckpointer(SAVE_NAME,max_to_keep=50)
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth=True
@@ -330,69 +397,53 @@ def main():
             print_num = int(checkpoint.split('-')[1])
             saver.restore(sess, checkpoint)
 
-        batch = []
+        if USE_TF_DATA:
+            producer.start(sess,datas)
+        else:
+            producer.start(sess,shuffled_batches(datas,BATCH_SIZE))
         batch_count = 0
+        tot_diff = 0
+        tot_dis = 0
+        rec_loss = 0
+        loss_count = 0
         while True:
-            for x in range(20):
-                random.shuffle(datas)
+            batch_count += 1
+            _,dif_l,dis_l,rec_l = sess.run([mc_update, diff_l, disting_l, reconst_l])
+            if batch_count % SPECNORM_INTERVAL == 0:
+                sess.run(layer_updates)
+            #print(sess.run(float_img))
+            loss_count += 1
+            tot_diff += dif_l
+            tot_dis += dis_l
+            rec_loss += rec_l
+
+            EPOC_SIZE = 50
+            if batch_count % EPOC_SIZE == 0:
+                print("epoc ended, loss: {}   {}    {}".format(tot_diff/loss_count,rec_loss/loss_count,tot_dis/loss_count),flush=True)
+                lossval_num += 1
+
                 tot_diff = 0
                 tot_dis = 0
                 rec_loss = 0
                 loss_count = 0
-                for data in datas:
-                    batch.append(data)
-                    if len(batch) == BATCH_SIZE:
-                        batch_count += 1
-                        img_batch = [img for img,repr in batch]
-                        repr_batch = [repr for img,repr in batch]
-                        _,dif_l,dis_l,rec_l = sess.run([mc_update, diff_l, disting_l, reconst_l],feed_dict={
-                            true_img:np.stack(img_batch),
-                            cmp_idxs:np.stack(repr_batch)
-                        })
-                        #print(sess.run(float_img))
-                        loss_count += 1
-                        tot_diff += dif_l
-                        tot_dis += dis_l
-                        rec_loss += rec_l
-                        batch = []
-
-                        EPOC_SIZE = 50
-                        if batch_count % EPOC_SIZE == 0:
-                            print("epoc ended, loss: {}   {}    {}".format(tot_diff/loss_count,rec_loss/loss_count,tot_dis/loss_count),flush=True)
-                            lossval_num += 1
-
-                            tot_diff = 0
-                            tot_dis = 0
-                            rec_loss = 0
-                            loss_count = 0
-
-                            if batch_count % (EPOC_SIZE*10) == 0:
-                                print_num += 1
-                                print("save {} started".format(print_num))
-                                saver.save(sess,SAVE_NAME,global_step=print_num)
-                                data_batch = []
-                                fold_batch = []
-                                for count,(data,fold) in enumerate(zip(orig_datas,out_fold_names)):
-                                    data_batch.append((data))
-                                    fold_batch.append((fold))
-                                    if len(data_batch) == BATCH_SIZE:
-
-                                        img_batch = [img for img,repr in data_batch]
-                                        repr_batch = [repr for img,repr in data_batch]
-                                        batch_outs = sess.run(final_img,feed_dict={
-                                            true_img:np.stack(img_batch),
-                                            cmp_idxs:np.stack(repr_batch)
-                                        })
-                                        pixel_vals = (batch_outs * 256).astype(np.uint8)
-                                        for out,out_fold in zip(pixel_vals,fold_batch):
-                                            #print(out.shape)
-                                            img = Image.fromarray(out)
-                                            img_path = "data/gen_result/{}/{}.jpg".format(out_fold,print_num)
-                                            #print(img_path)
-                                            img.save(img_path)
-                                        data_batch = []
-                                        fold_batch = []
-                                print("save {} finished".format(print_num))
+
+                if batch_count % (EPOC_SIZE*10) == 0:
+                    print_num += 1
+                    print("save {} started".format(print_num))
+                    checkpointer.save(sess,print_num)
+                    repr_batch = []
+                    fold_batch = []
+                    for count,(repr,fold) in enumerate(zip(reprs,out_fold_names)):
+                        repr_batch.append((repr))
+                        fold_batch.append((fold))
+                        if len(repr_batch) == BATCH_SIZE:
+                            pixel_vals = sess.run(preview_pixels,feed_dict={
+                                preview_idxs:np.stack(repr_batch)
+                            })
+                            exporter.submit(pixel_vals,["data/gen_result/{}/{}.jpg".format(out_fold,print_num) for out_fold in fold_batch])
+                            repr_batch = []
+                            fold_batch = []
+                    print("save {} finished".format(print_num))
 
 if __name__ == "__main__":
     main()
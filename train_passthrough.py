@@ -1,15 +1,32 @@
 import os
+import sys
 #os.environ['TF_ENABLE_AUTO_MIXED_PRECISION'] = '1'
 import tensorflow as tf
 import numpy as np
 from PIL import Image
 import random
 import shutil
-from base_ops import default_activ,Convpool2,Conv2d,Conv1x1,Conv1x1Upsample,ConvTrans2d,Convpool2,Deconv2
+from base_ops import default_activ,Convpool2,Conv2d,Conv1x1,Conv1x1Upsample,ConvTrans2d,Convpool2,Deconv2,height_axis,check_format,to_format,from_format
 from quant_block import QuantBlockImg
 from npy_saver import NpySaver
+from async_checkpoint import AsyncCheckpointer
+from sample_export import SampleExporter
+from img_shards import load_input_imgs,gather_rows
+from code_store import CodeWriter,CODES_FOLDER
+from async_worker import AsyncWorker
+from quant_engine import codebook_names,CODEBOOK_FOLDER
+from batch_producer import BatchProducer,DatasetProducer,shuffled_batches,uint8_to_float,random_flip,compose
 
 BATCH_SIZE = 64
+# feed training batches through tf.data instead of the python batch queue
+USE_TF_DATA = False
+# random left/right flips, only applied by the tf.data pipeline
+AUGMENT_FLIP = False
+# "exact", "approx", "float16" or "bfloat16" nearest codeword search in the quant blocks
+QUANT_SEARCH_MODE = "exact"
+# "NHWC" or "NCHW" layout inside MainCalc, inputs and outputs stay NHWC.
+# NCHW needs a gpu, see base_ops.check_format
+DATA_FORMAT = "NHWC"
 
 IMG_SIZE = (96,96)
 
@@ -33,35 +50,38 @@ FIFTH_LEVEL = 256
 ZIXTH_LEVEL = 256
 class MainCalc:
     def __init__(self):
-        self.convpool1 = Convpool2(3,IMG_LEVEL,default_activ)
-        self.convpool2 = Convpool2(IMG_LEVEL,SECOND_LEVEL,None)
-        self.convpool3 = Convpool2(SECOND_LEVEL,THIRD_LEVEL,default_activ)
-        self.convpool4 = Convpool2(THIRD_LEVEL,FOURTH_LEVEL,None)
-        self.convpool5 = Convpool2(FOURTH_LEVEL,FIFTH_LEVEL,default_activ)
-        self.convpool6 = Convpool2(FIFTH_LEVEL,ZIXTH_LEVEL,None)
-
-        self.quanttrans1 = Conv1x1(SECOND_LEVEL,SECOND_LEVEL,None)
-        self.quant_block1 = QuantBlockImg(256//2,2,SECOND_LEVEL//2)
-        self.quanttrans2 = Conv1x1(FOURTH_LEVEL,FOURTH_LEVEL,None)
-        self.quant_block2 = QuantBlockImg(256,4,FOURTH_LEVEL//4)
-        self.quant_block3 = QuantBlockImg(256,4,ZIXTH_LEVEL//4)
-
-        self.deconv6 = Deconv2(ZIXTH_LEVEL,FIFTH_LEVEL,default_activ,get_out_shape(6))
-        self.deconv5 = Deconv2(FIFTH_LEVEL,FOURTH_LEVEL,default_activ,get_out_shape(5))
-        self.deconv4 = Deconv2(FOURTH_LEVEL,THIRD_LEVEL,default_activ,get_out_shape(4))
-        self.deconv3 = Deconv2(THIRD_LEVEL,SECOND_LEVEL,default_activ,get_out_shape(3))
-        self.deconv2 = Deconv2(SECOND_LEVEL,IMG_LEVEL,default_activ,get_out_shape(2))
-        self.deconv1 = Deconv2(IMG_LEVEL,3,tf.sigmoid,get_out_shape(1))
-
-        self.quantupsample32 = Conv1x1Upsample(ZIXTH_LEVEL,FOURTH_LEVEL,None,get_out_shape(5),4)
-        self.quantupsample31 = Conv1x1Upsample(ZIXTH_LEVEL,SECOND_LEVEL,None,get_out_shape(3),16)
-        self.quantupsample21 = Conv1x1Upsample(FOURTH_LEVEL,SECOND_LEVEL,None,get_out_shape(3),4)
-
-        self.bn1a = tf.layers.BatchNormalization(axis=1)
-        self.bn1b = tf.layers.BatchNormalization(axis=1)
-        self.bn2a = tf.layers.BatchNormalization(axis=1)
-        self.bn2b = tf.layers.BatchNormalization(axis=1)
-        self.bn3 = tf.layers.BatchNormalization(axis=1)
+        check_format(DATA_FORMAT)
+        self.convpool1 = Convpool2(3,IMG_LEVEL,default_activ,data_format=DATA_FORMAT)
+        self.convpool2 = Convpool2(IMG_LEVEL,SECOND_LEVEL,None,data_format=DATA_FORMAT)
+        self.convpool3 = Convpool2(SECOND_LEVEL,THIRD_LEVEL,default_activ,data_format=DATA_FORMAT)
+        self.convpool4 = Convpool2(THIRD_LEVEL,FOURTH_LEVEL,None,data_format=DATA_FORMAT)
+        self.convpool5 = Convpool2(FOURTH_LEVEL,FIFTH_LEVEL,default_activ,data_format=DATA_FORMAT)
+        self.convpool6 = Convpool2(FIFTH_LEVEL,ZIXTH_LEVEL,None,data_format=DATA_FORMAT)
+
+        self.quanttrans1 = Conv1x1(SECOND_LEVEL,SECOND_LEVEL,None,data_format=DATA_FORMAT)
+        self.quant_block1 = QuantBlockImg(256//2,2,SECOND_LEVEL//2,search_mode=QUANT_SEARCH_MODE,data_format=DATA_FORMAT)
+        self.quanttrans2 = Conv1x1(FOURTH_LEVEL,FOURTH_LEVEL,None,data_format=DATA_FORMAT)
+        self.quant_block2 = QuantBlockImg(256,4,FOURTH_LEVEL//4,search_mode=QUANT_SEARCH_MODE,data_format=DATA_FORMAT)
+        self.quant_block3 = QuantBlockImg(256,4,ZIXTH_LEVEL//4,search_mode=QUANT_SEARCH_MODE,data_format=DATA_FORMAT)
+
+        self.deconv6 = Deconv2(ZIXTH_LEVEL,FIFTH_LEVEL,default_activ,get_out_shape(6),data_format=DATA_FORMAT)
+        self.deconv5 = Deconv2(FIFTH_LEVEL,FOURTH_LEVEL,default_activ,get_out_shape(5),data_format=DATA_FORMAT)
+        self.deconv4 = Deconv2(FOURTH_LEVEL,THIRD_LEVEL,default_activ,get_out_shape(4),data_format=DATA_FORMAT)
+        self.deconv3 = Deconv2(THIRD_LEVEL,SECOND_LEVEL,default_activ,get_out_shape(3),data_format=DATA_FORMAT)
+        self.deconv2 = Deconv2(SECOND_LEVEL,IMG_LEVEL,default_activ,get_out_shape(2),data_format=DATA_FORMAT)
+        self.deconv1 = Deconv2(IMG_LEVEL,3,tf.sigmoid,get_out_shape(1),data_format=DATA_FORMAT)
+
+        self.quantupsample32 = Conv1x1Upsample(ZIXTH_LEVEL,FOURTH_LEVEL,None,get_out_shape(5),4,data_format=DATA_FORMAT)
+        self.quantupsample31 = Conv1x1Upsample(ZIXTH_LEVEL,SECOND_LEVEL,None,get_out_shape(3),16,data_format=DATA_FORMAT)
+        self.quantupsample21 = Conv1x1Upsample(FOURTH_LEVEL,SECOND_LEVEL,None,get_out_shape(3),4,data_format=DATA_FORMAT)
+
+        # these normalise over image rows, axis 1 of the original NHWC graph.
+        # height_axis keeps that in both layouts, and keeps checkpoints loading
+        self.bn1a = tf.layers.BatchNormalization(axis=height_axis(DATA_FORMAT))
+        self.bn1b = tf.layers.BatchNormalization(axis=height_axis(DATA_FORMAT))
+        self.bn2a = tf.layers.BatchNormalization(axis=height_axis(DATA_FORMAT))
+        self.bn2b = tf.layers.BatchNormalization(axis=height_axis(DATA_FORMAT))
+        self.bn3 = tf.layers.BatchNormalization(axis=height_axis(DATA_FORMAT))
         #self.deconvbn2 = tf.layers.BatchNormalization()
 
     # def all_save_vars(self):
@@ -77,27 +97,27 @@ class MainCalc:
     #         self.quant_block3.vars("qblock3")
     #     )
 
-    def calc(self,input):
-        out1 = self.convpool1.calc(input)
+    def calc(self,input,training=True):
+        out1 = self.convpool1.calc(to_format(input,DATA_FORMAT))
         out2 = self.convpool2.calc(out1)
         out3 = self.convpool3.calc(out2)
         out4 = self.convpool4.calc(out3)
         out5 = self.convpool5.calc(out4)
         out6 = self.convpool6.calc(out5)
 
-        quant3,quant_loss3,update3,closest3 = self.quant_block3.calc((self.bn3(out6,training=True)*0.5))
+        quant3,quant_loss3,update3,closest3 = self.quant_block3.calc((self.bn3(out6,training=training)*0.5))
         dec6 = self.deconv6.calc(quant3)
         dec5 = self.deconv5.calc(dec6)
         out4trans = self.quanttrans2.calc(out4)
 
-        quant2,quant_loss2,update2,closest2 = self.quant_block2.calc(((self.bn1a(dec5,training=True)+self.bn1b(out4trans,training=True)))*0.5)
+        quant2,quant_loss2,update2,closest2 = self.quant_block2.calc(((self.bn1a(dec5,training=training)+self.bn1b(out4trans,training=training)))*0.5)
         dec4 = self.deconv4.calc(quant2+self.quantupsample32.calc(quant3))
         dec3 = self.deconv3.calc(dec4)
         out2trans = self.quanttrans1.calc(out2)
-        quant1,quant_loss1,update1,closest1 = self.quant_block1.calc(self.bn2a(dec3,training=True)+self.bn2b(out2trans,training=True))
+        quant1,quant_loss1,update1,closest1 = self.quant_block1.calc(self.bn2a(dec3,training=training)+self.bn2b(out2trans,training=training))
         dec2 = self.deconv2.calc(quant1+self.quantupsample21.calc(quant2)+self.quantupsample31.calc(quant3))
         dec1 = self.deconv1.calc(dec2)
-        decoded_final = dec1
+        decoded_final = from_format(dec1,DATA_FORMAT)
 
         reconstr_loss = tf.reduce_sum(sqr(decoded_final - input))
 
@@ -128,6 +148,18 @@ class MainCalc:
     #     tot_loss = reconstr_loss + quant_loss
     #     return update,tot_loss, reconstr_loss,decoded_final
 
+    def rebuild_search_indexes(self,sess):
+        self.quant_block1.rebuild_search_index(sess)
+        self.quant_block2.rebuild_search_index(sess)
+        self.quant_block3.rebuild_search_index(sess)
+
+    def quant_summaries(self):
+        return [
+            self.quant_block1.summary(),
+            self.quant_block2.summary(),
+            self.quant_block3.summary(),
+        ]
+
     def periodic_update(self):
         return tf.group([
             self.quant_block1.resample_bad_vecs(),
@@ -137,13 +169,20 @@ class MainCalc:
 
 def main():
     mc = MainCalc()
-    place = tf.placeholder(shape=[BATCH_SIZE,96,96,3],dtype=tf.uint8)
-    img_place = tf.cast(place,dtype=tf.float32)/256.0
+    if USE_TF_DATA:
+        map_fn = compose(random_flip,uint8_to_float) if AUGMENT_FLIP else uint8_to_float
+        producer = DatasetProducer([[BATCH_SIZE,96,96,3]],[tf.uint8],map_fn=map_fn)
+        img_place, = producer.dequeue()
+    else:
+        producer = BatchProducer([[BATCH_SIZE,96,96,3]],[tf.uint8])
+        place, = producer.dequeue()
+        img_place = tf.cast(place,dtype=tf.float32)/256.0
 
     optimizer = tf.train.AdamOptimizer(learning_rate=0.0001)
 
     mc_update, loss, reconst_l, final_output,closest_list = mc.calc(img_place)
     resample_update = mc.periodic_update()
+    quant_summaries = mc.quant_summaries()
 
     batchnorm_updates = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     print(batchnorm_updates)
@@ -151,27 +190,31 @@ def main():
     tot_update = tf.group([mc_update,comb_updates])
 
     opt = optimizer.minimize(loss)
-    orig_imgs = []
-    orig_filenames = []
-    for img_name in os.listdir("data/input_data"):
-        with Image.open("data/input_data/"+img_name) as img:
-            if img.mode == "RGB":
-                arr = np.array(img)
-                orig_imgs.append(arr)
-                orig_filenames.append(img_name)
+
+    # inference only copy of the model for the result previews, sharing the
+    # trained variables. none of its update ops are ever run
+    preview_place = tf.placeholder(tf.uint8,[BATCH_SIZE,96,96,3])
+    _,_,_,preview_output,_ = mc.calc(tf.cast(preview_place,tf.float32)/256.0,training=False)
+    preview_pixels = tf.cast(preview_output*256.0,tf.uint8)
+    exporter = SampleExporter()
+
+    orig_imgs,orig_filenames = load_input_imgs()
 
     fold_names = [fname.split('.')[0]+"/" for fname in orig_filenames[:50]]
 
-    for fold,fname in zip(fold_names,orig_filenames):
+    # reference images come from the loaded pixels, so a shard only setup
+    # needs no decoded image folder
+    for idx,fold in enumerate(fold_names):
         fold_path = "data/result/"+fold
         os.makedirs(fold_path,exist_ok=True)
-        shutil.copy("data/input_data/"+fname,fold_path+"org.jpg")
+        Image.fromarray(np.asarray(orig_imgs[idx])).save(fold_path+"org.jpg")
 
-    imgs = [img for img in orig_imgs]
+    imgs = orig_imgs
     saver = tf.train.Saver(max_to_keep=50)
     SAVE_DIR = "data/save_model/"
     os.makedirs(SAVE_DIR,exist_ok=True)
     SAVE_NAME = SAVE_DIR+"model.ckpt"
+    checkpointer = AsyncCheckpointer(SAVE_NAME,max_to_keep=50)
     logfilename = "data/count_log.txt"
     logfile = open(logfilename,'w')
 
@@ -179,6 +222,7 @@ def main():
     config.gpu_options.allow_growth=True
     with tf.Session(config=config) as sess:
         sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
         print_num = 0
         lossval_num = 0
         if os.path.exists(SAVE_DIR+"checkpoint"):
@@ -187,90 +231,74 @@ def main():
             print(checkpoint)
             print_num = int(checkpoint.split('-')[1])
             saver.restore(sess, checkpoint)
+        mc.rebuild_search_indexes(sess)
 
-        batch = []
+        if USE_TF_DATA:
+            producer.start(sess,(imgs,))
+        else:
+            producer.start(sess,shuffled_batches((imgs,),BATCH_SIZE))
         batch_count = 0
+        tot_loss = 0
+        rec_loss = 0
+        loss_count = 0
         while True:
-            for x in range(20):
-                random.shuffle(imgs)
+            batch_count += 1
+            _,_,cur_loss,cur_rec = sess.run([tot_update,opt,loss,reconst_l])
+            loss_count += 1
+            tot_loss += cur_loss
+            rec_loss += cur_rec
+
+            EPOC_SIZE = 300
+            if batch_count % EPOC_SIZE == 0:
+                print("epoc ended, loss: {}   {}".format(tot_loss/loss_count,rec_loss/loss_count))
+                lossval_num += 1
+                for level,(dead_count,perplexity) in enumerate(sess.run(quant_summaries)):
+                    summary = "step {} quant {} dead {} perplexity {}".format(
+                        lossval_num,level+1,dead_count," ".join("{:.1f}".format(val) for val in perplexity))
+                    print(summary)
+                    logfile.write(summary+"\n")
+                logfile.flush()
+                sess.run(resample_update)
+                mc.rebuild_search_indexes(sess)
+
                 tot_loss = 0
                 rec_loss = 0
                 loss_count = 0
-                for img in imgs:
-                    batch.append(img)
-                    if len(batch) == BATCH_SIZE:
-                        batch_count += 1
-                        _,_,cur_loss,cur_rec = sess.run([tot_update,opt,loss,reconst_l],feed_dict={
-                            place:np.stack(batch)
+
+                if batch_count % (EPOC_SIZE*10) == 0:
+                    print_num += 1
+                    print("save {} started".format(print_num))
+                    checkpointer.save(sess,print_num)
+                    num_previews = len(fold_names)
+                    for idx in range(0,num_previews,BATCH_SIZE):
+                        # a partial batch is padded by wrapping around, the
+                        # preview pass is in inference mode so padding rows
+                        # do not change the real outputs and are dropped
+                        batch_idxs = np.arange(idx,idx+BATCH_SIZE) % num_previews
+                        num_valid = min(BATCH_SIZE,num_previews-idx)
+                        pixel_vals = sess.run(preview_pixels,feed_dict={
+                            preview_place:gather_rows(orig_imgs,batch_idxs)
                         })
-                        loss_count += 1
-                        tot_loss += cur_loss
-                        rec_loss += cur_rec
-                        batch = []
-
-                        EPOC_SIZE = 300
-                        if batch_count % EPOC_SIZE == 0:
-                            print("epoc ended, loss: {}   {}".format(tot_loss/loss_count,rec_loss/loss_count))
-                            lossval_num += 1
-                            logfile.write("counts step {} quant 1".format(lossval_num))
-                            logfile.write(",".join([str(val.astype(np.int64)) for val in sess.run(mc.quant_block1.vector_counts)])+"\n")
-                            logfile.write("counts step {} quant 2".format(lossval_num))
-                            logfile.write(",".join([str(val.astype(np.int64)) for val in sess.run(mc.quant_block2.vector_counts)])+"\n")
-                            logfile.write("counts step {} quant 3".format(lossval_num))
-                            logfile.write(",".join([str(val.astype(np.int64)) for val in sess.run(mc.quant_block3.vector_counts)])+"\n")
-                            logfile.flush()
-                            sess.run(resample_update)
-
-                            tot_loss = 0
-                            rec_loss = 0
-                            loss_count = 0
-
-                            if batch_count % (EPOC_SIZE*10) == 0:
-                                print_num += 1
-                                print("save {} started".format(print_num))
-                                saver.save(sess,SAVE_NAME,global_step=print_num)
-                                img_batch = []
-                                fold_batch = []
-                                for count,(img,fold) in enumerate(zip(orig_imgs,fold_names)):
-                                    img_batch.append((img))
-                                    fold_batch.append((fold))
-                                    if len(img_batch) == BATCH_SIZE:
-                                        batch_outs = sess.run(final_output,feed_dict={
-                                            place:np.stack(img_batch)
-                                        })
-                                        pixel_vals = (batch_outs * 256).astype(np.uint8)
-                                        for out,out_fold in zip(pixel_vals,fold_batch):
-                                            #print(out.shape)
-                                            out = np.transpose(out,(1,2,0))
-                                            img = Image.fromarray(out)
-                                            img_path = "data/result/{}{}.jpg".format(out_fold,print_num)
-                                            #print(img_path)
-                                            img.save(img_path)
-                                        img_batch = []
-                                        fold_batch = []
-                                print("save {} finished".format(print_num))
+                        exporter.submit(pixel_vals[:num_valid],["data/result/{}{}.jpg".format(out_fold,print_num)
+                                                                for out_fold in fold_names[idx:idx+num_valid]])
+                    print("save {} finished".format(print_num))
 
 def calc_closest_vals():
     mc = MainCalc()
     place = tf.placeholder(shape=[BATCH_SIZE,96,96,3],dtype=tf.uint8)
     img_place = tf.cast(place,dtype=tf.float32)/256.0
 
-    mc_update, loss, reconst_l, final_output,closest_list = mc.calc(img_place)
-
-    orig_imgs = []
-    orig_filenames = []
-    for img_name in os.listdir("data/input_data"):
-        with Image.open("data/input_data/"+img_name) as img:
-            if img.mode == "RGB":
-                arr = np.array(img)
-                orig_imgs.append(arr)
-                orig_filenames.append(img_name)
+    # inference mode, so each image's codes do not depend on the rest of its batch
+    mc_update, loss, reconst_l, final_output,closest_list = mc.calc(img_place,training=False)
 
-    full_fold_names = [fname.split('.')[0]+"/" for fname in orig_filenames]
+    orig_imgs,orig_filenames = load_input_imgs()
 
     imgs = orig_imgs
-    out_path = "data/pretrained_result/"
-    os.mkdir(out_path)
+    num_imgs = len(imgs)
+    level_shapes = [close.get_shape().as_list()[1:] for close in closest_list]
+    code_writer = CodeWriter(CODES_FOLDER,orig_filenames,level_shapes)
+    # writes run behind the encoder so sess.run calls go back to back
+    write_worker = AsyncWorker(max_pending=8)
     full_saver = tf.train.Saver(max_to_keep=20)
     SAVE_DIR = "data/save_model/"
 
@@ -281,24 +309,43 @@ def calc_closest_vals():
         print(checkpoint)
         print_num = int(checkpoint.split('-')[1])
         full_saver.restore(sess, checkpoint)
-        for idx in range(0,len(imgs)-BATCH_SIZE+1,BATCH_SIZE):
-            batch = np.stack(imgs[idx:idx+BATCH_SIZE])
+        mc.rebuild_search_indexes(sess)
+        for idx in range(0,num_imgs,BATCH_SIZE):
+            # the final partial batch is padded by wrapping around to the
+            # first images, the padding rows' codes are dropped
+            batch_idxs = np.arange(idx,idx+BATCH_SIZE) % num_imgs
+            batch = gather_rows(imgs,batch_idxs)
+            num_valid = min(BATCH_SIZE,num_imgs-idx)
 
             out_closest_list = sess.run(closest_list,feed_dict={
                 place:batch
             })
-            closest1,closest2,closest3 = [close.astype(np.uint16) for close in out_closest_list]
-            for bidx in range(BATCH_SIZE):
-                img_idx = bidx + idx
-                new_path = out_path+full_fold_names[img_idx]
-                os.mkdir(new_path)
-                #image_data = imgs[img_idx]
-                #image_data = np.transpose(image_data,(1,2,0))
-                #image_data = (image_data*256).astype(np.uint8)
-                #np.save(new_path+"image.npy",image_data)
-                np.save(new_path+"closest1.npy",closest1[bidx])
-                np.save(new_path+"closest2.npy",closest2[bidx])
-                np.save(new_path+"closest3.npy",closest3[bidx])
+            write_worker.submit(code_writer.write,idx,[close[:num_valid] for close in out_closest_list])
+    write_worker.close()
+    code_writer.close()
+
+def export_codebooks():
+    # writes the codebooks of the latest checkpoint for quant_engine.NumpyQuantizer
+    mc = MainCalc()
+    os.makedirs(CODEBOOK_FOLDER,exist_ok=True)
+    codebook_saver = NpySaver(CODEBOOK_FOLDER)
+    blocks = [("quant1",mc.quant_block1),("quant2",mc.quant_block2),("quant3",mc.quant_block3)]
+    for name,block in blocks:
+        vecs_name,cluster_name = codebook_names(name)
+        codebook_saver.add(block.vectors,vecs_name)
+        codebook_saver.add(block._ema_cluster_size,cluster_name)
+    codebook_vars = [block.vectors for name,block in blocks]+[block._ema_cluster_size for name,block in blocks]
+    full_saver = tf.train.Saver(var_list=codebook_vars)
+    SAVE_DIR = "data/save_model/"
+
+    with tf.Session() as sess:
+        checkpoint = tf.train.latest_checkpoint(SAVE_DIR)
+        print(checkpoint)
+        full_saver.restore(sess, checkpoint)
+        codebook_saver.save_all(sess)
 
 if __name__ == "__main__":
-    calc_closest_vals()
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        export_codebooks()
+    else:
+        calc_closest_vals()